@@ -0,0 +1,188 @@
+"""Benchmarks for the TenorSax front ends.
+
+Each benchmark generates a synthetic document with tenorsax.bench.corpus,
+processes it and reports how long was spent in each stage of processing.  For
+troff, the stages are the lexer, the execution of requests and macros, the
+emission of SAX events and the XSLT filter; for AsciiDoc and Markdown, they are
+the parser and the content handler it emits events to.
+"""
+
+import collections
+import itertools
+import os.path
+import platform
+import time
+import xml.sax.handler
+
+import tenorsax.filters.xslt
+import tenorsax.sources.asciidoc.parse
+import tenorsax.sources.markdown.parse
+import tenorsax.sources.troff.parse
+
+from tenorsax.bench import corpus
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+class StageTimer:
+    """Accumulates the time spent in each stage of processing.
+
+    Stages may nest; time spent in an inner stage is not counted toward the
+    stage enclosing it.
+    """
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.frames = []
+        self.times = collections.Counter()
+    def enter(self, stage):
+        self.frames.append([stage, self.clock(), 0.0])
+    def leave(self):
+        (stage, start, inner) = self.frames.pop()
+        elapsed = self.clock() - start
+        self.times[stage] += elapsed - inner
+        if self.frames:
+            self.frames[-1][2] += elapsed
+    def call(self, stage, func, *args, **kwargs):
+        self.enter(stage)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.leave()
+    def wrap(self, stage, obj):
+        """Return a proxy for obj whose method calls are timed as stage."""
+        return TimedProxy(self, stage, obj)
+
+class TimedProxy:
+    def __init__(self, timer, stage, obj):
+        self._timer = timer
+        self._stage = stage
+        self._obj = obj
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+        timer = self._timer
+        stage = self._stage
+        def timed(*args, **kwargs):
+            return timer.call(stage, attr, *args, **kwargs)
+        self.__dict__[name] = timed
+        return timed
+
+class _TimedTroffParser(tenorsax.sources.troff.parse.Parser):
+    def __init__(self, ch, timer):
+        super().__init__(timer.wrap("xslt", ch))
+        self.timer = timer
+        self.state.ch = timer.wrap("sax", self.state.ch)
+    def _items(self, items):
+        timer = self.timer
+        while True:
+            timer.enter("lexer")
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                timer.leave()
+            if item is not None:
+                item = timer.wrap("requests", item)
+            yield item
+    def _process(self, items):
+        super()._process(self._items(items))
+
+def _tmac(name):
+    return os.path.join(TOPDIR, "tmac", name + ".tmac")
+
+def run_troff(text, macros=(), stylesheet=None):
+    """Process text as troff and return the time spent in each stage."""
+    timer = StageTimer()
+    if stylesheet is None:
+        stylesheet = os.path.join(TOPDIR, "xslt", "trim.xsl")
+    f = tenorsax.filters.xslt.TextXSLTTransformer(None, stylesheet)
+    p = _TimedTroffParser(f, timer)
+    Parser = tenorsax.sources.troff.parse.Parser
+    paths = [_tmac("init")] + [_tmac(m) for m in macros]
+    source = itertools.chain(Parser._read_files(paths),
+            [Parser._filename_request("<benchmark>"), text])
+    start = timer.clock()
+    p.parse(source)
+    return _result(timer, start)
+
+def run_fancy(klass, text):
+    """Process text with a FancyTextParser subclass and return stage times."""
+    timer = StageTimer()
+    ch = timer.wrap("sax", xml.sax.handler.ContentHandler())
+    p = klass(ch)
+    start = timer.clock()
+    timer.call("parser", p.parse, text.splitlines(True))
+    return _result(timer, start)
+
+def run_asciidoc(text):
+    return run_fancy(tenorsax.sources.asciidoc.parse.AsciiDocParser, text)
+
+def run_markdown(text):
+    return run_fancy(tenorsax.sources.markdown.parse.MarkdownParser, text)
+
+def _result(timer, start):
+    total = timer.clock() - start
+    stages = dict(timer.times)
+    stages["other"] = max(total - sum(stages.values()), 0.0)
+    stages["total"] = total
+    return stages
+
+CORPORA = collections.OrderedDict([
+    ("troff-text", (corpus.troff_text, run_troff, {})),
+    ("troff-macros", (corpus.troff_macros, run_troff,
+        {"macros": ("xd",)})),
+    ("troff-numeric", (corpus.troff_numeric, run_troff, {})),
+    ("asciidoc-quotes", (corpus.asciidoc_quotes, run_asciidoc, {})),
+    ("markdown-long", (corpus.markdown_long, run_markdown, {})),
+])
+
+def generate(name, size, seed=0):
+    """Return the document for the named corpus."""
+    return CORPORA[name][0](size, seed)
+
+def run(names=None, size=100, repeat=3, seed=0):
+    """Run the named benchmarks and return the results.
+
+    Each benchmark is run repeat times, and the best time for each stage is
+    kept.
+    """
+    results = collections.OrderedDict()
+    for name in names or CORPORA.keys():
+        (gen, runner, kwargs) = CORPORA[name]
+        text = gen(size, seed)
+        best = {}
+        for i in range(repeat):
+            for stage, elapsed in runner(text, **kwargs).items():
+                best[stage] = min(best.get(stage, elapsed), elapsed)
+        results[name] = {"size": size, "bytes": len(text.encode("UTF-8")),
+                "stages": best}
+    return {
+        "version": 1,
+        "python": platform.python_version(),
+        "seed": seed,
+        "repeat": repeat,
+        "results": results,
+    }
+
+def compare(baseline, current, threshold=0.1, floor=0.001):
+    """Compare two sets of results.
+
+    Return a list of (benchmark, stage, old, new, regressed) tuples for each
+    stage present in both.  A stage has regressed if it is more than threshold
+    slower, relatively, and more than floor seconds slower, absolutely.
+    Benchmarks run at different sizes are skipped.
+    """
+    rows = []
+    for name, new in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None or old["size"] != new["size"]:
+            continue
+        for stage, t in new["stages"].items():
+            if stage not in old["stages"]:
+                continue
+            o = old["stages"][stage]
+            regressed = t > o * (1 + threshold) and t - o > floor
+            rows.append((name, stage, o, t, regressed))
+    return rows
@@ -0,0 +1,86 @@
+import json
+import optparse
+import sys
+
+import tenorsax.bench
+
+USAGE = """%prog run [options] [BENCHMARK...]
+       %prog compare [options] BASELINE RESULTS
+       %prog generate [options] BENCHMARK
+       %prog list"""
+
+def do_run(options, args):
+    for name in args:
+        if name not in tenorsax.bench.CORPORA:
+            print("E: unknown benchmark '{}'".format(name), file=sys.stderr)
+            return 2
+    results = tenorsax.bench.run(args, options.size, options.repeat,
+            options.seed)
+    for name, res in results["results"].items():
+        stages = res["stages"]
+        print("{:<16} {:>8} bytes {:>10.3f} ms total".format(name,
+            res["bytes"], stages["total"] * 1e3))
+        for stage in sorted(stages):
+            if stage != "total":
+                print("    {:<12} {:>10.3f} ms".format(stage,
+                    stages[stage] * 1e3))
+    if options.output:
+        with open(options.output, "w", encoding="UTF-8") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+    return 0
+
+def do_compare(options, args):
+    if len(args) != 2:
+        print("E: compare needs a baseline and a result file", file=sys.stderr)
+        return 2
+    results = []
+    for path in args:
+        with open(path, encoding="UTF-8") as fp:
+            results.append(json.load(fp))
+    (baseline, current) = results
+    rows = tenorsax.bench.compare(baseline, current, options.threshold)
+    status = 0
+    for (name, stage, old, new, regressed) in rows:
+        change = (new - old) / old * 100 if old else 0.0
+        print("{:<16} {:<12} {:>10.3f} {:>10.3f} {:>+8.1f}%{}".format(name,
+            stage, old * 1e3, new * 1e3, change,
+            "  REGRESSION" if regressed else ""))
+        if regressed:
+            status = 1
+    return status
+
+def do_generate(options, args):
+    if len(args) != 1 or args[0] not in tenorsax.bench.CORPORA:
+        print("E: generate needs one known benchmark name", file=sys.stderr)
+        return 2
+    sys.stdout.write(tenorsax.bench.generate(args[0], options.size,
+        options.seed))
+    return 0
+
+def do_list(options, args):
+    for name in tenorsax.bench.CORPORA:
+        print(name)
+    return 0
+
+def main():
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option("-n", dest="size", type="int", default=100,
+            help="size of each generated document")
+    parser.add_option("-r", dest="repeat", type="int", default=3,
+            help="number of times to run each benchmark")
+    parser.add_option("-s", dest="seed", type="int", default=0,
+            help="seed for the document generator")
+    parser.add_option("-o", dest="output", help="write results as JSON")
+    parser.add_option("-t", dest="threshold", type="float", default=0.1,
+            help="relative slowdown counted as a regression")
+    (options, args) = parser.parse_args()
+    commands = {"run": do_run, "compare": do_compare, "generate": do_generate,
+            "list": do_list}
+    if not args or args[0] not in commands:
+        parser.print_usage(sys.stderr)
+        return 2
+    return commands[args[0]](options, args[1:])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""Generators for synthetic benchmark inputs.
+
+Each generator takes a size, which is roughly the number of paragraphs or
+sections to produce, and a seed, and returns the document as a string.  The
+same size and seed always produce the same document.
+"""
+
+import random
+
+WORDS = """
+alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike
+november oscar papa quebec romeo sierra tango uniform victor whiskey xray
+yankee zulu the of and to in is was for on are as with his they at be this
+from have or by one had not but what all were when we there can an your which
+their said if do will each about how up out them then she many some so these
+would other into has more her two like him see time could no make than first
+been its who now people my made over did down only way find use may water long
+little very after words called just where most know
+""".split()
+
+class _Writer:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.lines = []
+    def words(self, lo, hi):
+        return [self.rng.choice(WORDS) for i in range(self.rng.randint(lo, hi))]
+    def sentence(self, lo=6, hi=14):
+        return " ".join(self.words(lo, hi)).capitalize() + "."
+    def emit(self, line):
+        self.lines.append(line)
+    def getvalue(self):
+        return "\n".join(self.lines) + "\n"
+
+def troff_text(size, seed=0):
+    """Mostly plain prose with occasional font changes and breaks."""
+    w = _Writer(seed)
+    for i in range(size):
+        for j in range(w.rng.randint(4, 10)):
+            words = w.words(8, 16)
+            if w.rng.random() < 0.2:
+                k = w.rng.randrange(len(words))
+                words[k] = "\\fB" + words[k] + "\\fP"
+            w.emit(" ".join(words))
+        w.emit(".br")
+    return w.getvalue()
+
+def troff_macros(size, seed=0):
+    """A document using the xd macro package, to be run with -mxd."""
+    w = _Writer(seed)
+    w.emit(".article")
+    w.emit('.title "' + " ".join(w.words(2, 5)) + '"')
+    for i in range(size):
+        w.emit(".pp")
+        for j in range(w.rng.randint(2, 5)):
+            w.emit(w.sentence())
+            choice = w.rng.random()
+            if choice < 0.3:
+                w.emit(".b " + w.rng.choice(WORDS))
+            elif choice < 0.6:
+                w.emit(".i " + w.rng.choice(WORDS))
+            elif choice < 0.8:
+                w.emit('.q "' + " ".join(w.words(2, 4)) + '"')
+        if i % 5 == 4:
+            w.emit(".list " + w.rng.choice("BN"))
+            for j in range(w.rng.randint(2, 6)):
+                w.emit('.item "' + w.sentence(2, 5) + '"')
+            w.emit(".endlist")
+    w.emit(".done")
+    return w.getvalue()
+
+def troff_numeric(size, seed=0):
+    """Number registers, arithmetic and conditionals."""
+    w = _Writer(seed)
+    w.emit(".nr na 0 1")
+    w.emit(".nr nb 7")
+    w.emit(".ds ye " + w.rng.choice(WORDS))
+    for i in range(size):
+        n = w.rng.randint(1, 99)
+        w.emit(".nr nc " + str(n))
+        w.emit(".nr nb +" + str(w.rng.randint(1, 9)))
+        w.emit(".nr nd \\n(nc*3+\\n(nb")
+        w.emit(".if \\n(nc>50 " + " ".join(w.words(3, 8)))
+        w.emit(".ie \\n(nc%2 odd \\n(nc")
+        w.emit(".el even \\n(nc")
+        w.emit(".if '\\*(ye'" + w.rng.choice(WORDS) + "' match")
+        w.emit("Counter \\n+(na and \\n(nd.")
+        w.emit(".br")
+    return w.getvalue()
+
+def asciidoc_quotes(size, seed=0):
+    """AsciiDoc with inline quotes, replacements and entities on every line."""
+    w = _Writer(seed)
+    marks = [("*", "*"), ("_", "_"), ("'", "'"), ("``", "''"), ("+", "+"),
+            ("**", "**"), ("++", "++"), ("#", "#"), ("^", "^"), ("~", "~")]
+    extras = ["(C)", "(TM)", "--", "...", "->", "<=", "&#169;", "&#x2014;",
+            "\\*"]
+    title = w.sentence(2, 4)
+    w.emit(title)
+    w.emit("=" * len(title))
+    w.emit("")
+    for i in range(size):
+        if i % 10 == 9:
+            title = w.sentence(2, 4)
+            w.emit(title)
+            w.emit("-" * len(title))
+            w.emit("")
+        for j in range(w.rng.randint(2, 6)):
+            words = w.words(6, 14)
+            for k in range(w.rng.randint(1, 4)):
+                (lq, rq) = w.rng.choice(marks)
+                m = w.rng.randrange(len(words))
+                words[m] = lq + words[m] + rq
+            words.insert(w.rng.randrange(len(words)), w.rng.choice(extras))
+            w.emit(" ".join(words))
+        w.emit("")
+    return w.getvalue()
+
+def markdown_long(size, seed=0):
+    """A long Markdown document with headings and emphasis."""
+    w = _Writer(seed)
+    for i in range(size):
+        if i % 8 == 0:
+            w.emit("#" * w.rng.randint(1, 3) + " " + w.sentence(2, 5))
+            w.emit("")
+        elif i % 8 == 4:
+            title = w.sentence(2, 5)
+            w.emit(title)
+            w.emit(w.rng.choice("=-") * len(title))
+            w.emit("")
+        for j in range(w.rng.randint(3, 8)):
+            words = w.words(8, 16)
+            if w.rng.random() < 0.5:
+                m = w.rng.randrange(len(words))
+                mark = w.rng.choice(["*", "**", "_", "`"])
+                words[m] = mark + words[m] + mark
+            w.emit(" ".join(words))
+        w.emit("")
+    return w.getvalue()
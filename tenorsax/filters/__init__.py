@@ -0,0 +1,39 @@
+import os.path
+
+from tenorsax.filters.native import FilterError, TrimFilter, XMLFormatFilter
+
+# The directories holding the stylesheets shipped with TenorSax: the source
+# tree and the places they are installed.
+_shipped_dirs = (os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), "xslt"),
+    "/usr/local/share/tenorsax/xslt", "/usr/share/tenorsax/xslt")
+
+def _is_shipped(stylesheet, name):
+    """Return whether stylesheet is the shipped stylesheet called name."""
+    path = os.path.realpath(stylesheet)
+    if os.path.basename(path) != name:
+        return False
+    d = os.path.dirname(path)
+    return any(d == os.path.realpath(s) for s in _shipped_dirs)
+
+def text_filter(output, stylesheet):
+    """Return a filter writing the text stylesheet produces to output.
+
+    The shipped xslt/trim.xsl is implemented natively; any other stylesheet is
+    run with lxml.
+    """
+    if _is_shipped(stylesheet, "trim.xsl"):
+        return TrimFilter(output)
+    import tenorsax.filters.xslt
+    return tenorsax.filters.xslt.TextXSLTTransformer(output, stylesheet)
+
+def xml_filter(base, stylesheet):
+    """Return a filter sending the document stylesheet produces to base.
+
+    The shipped xslt/format-xml.xsl is implemented natively; any other
+    stylesheet is run with lxml.
+    """
+    if _is_shipped(stylesheet, "format-xml.xsl"):
+        return XMLFormatFilter(base)
+    import tenorsax.filters.xslt
+    return tenorsax.filters.xslt.XSLTTransformer(base, stylesheet)
@@ -0,0 +1,170 @@
+import io
+import re
+import xml.sax.handler
+
+NS_TROFF = "http://ns.crustytoothpaste.net/troff"
+NS_XML = "http://www.w3.org/XML/1998/namespace"
+
+class FilterError(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+    def __str__(self):
+        return self.reason
+
+class TrimFilter(xml.sax.handler.ContentHandler):
+    """Writes the text of a document as xslt/trim.xsl would.
+
+    The text of each troff block is written on a line of its own with its
+    whitespace normalized, and page breaks are dropped.  Text outside blocks is
+    written as is, except for text directly inside the main troff element.
+    Output is written as each block ends; if output is None, it is kept and
+    returned by get_string instead.
+    """
+    # What happens to text in the current element: it is written, dropped,
+    # gathered into the current block or, directly inside main, dropped while
+    # the elements inside are still processed.
+    COPY, SKIP, BLOCK, MAIN = range(4)
+    _space = re.compile("[ \t\r\n]+")
+    def __init__(self, output=None):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.buffer = io.StringIO() if output is None else None
+        self.output = output if output is not None else self.buffer
+        self.modes = [self.COPY]
+        self.text = []
+    def startElementNS(self, name, qname, attrs):
+        mode = self.modes[-1]
+        if mode == self.SKIP or mode == self.BLOCK:
+            pass
+        elif name[0] != NS_TROFF:
+            mode = self.COPY
+        elif name[1] == "block":
+            mode = self.BLOCK
+        elif name[1] == "main":
+            mode = self.MAIN
+        elif name[1] == "break-page":
+            mode = self.SKIP
+        else:
+            mode = self.COPY
+        self.modes.append(mode)
+    def endElementNS(self, name, qname):
+        mode = self.modes.pop()
+        if mode == self.BLOCK and self.modes[-1] != self.BLOCK:
+            text = self._space.sub(" ", "".join(self.text)).strip(" ")
+            self.text = []
+            if text:
+                self.output.write(text + "\n")
+    def characters(self, content):
+        mode = self.modes[-1]
+        if mode == self.COPY:
+            self.output.write(content)
+        elif mode == self.BLOCK:
+            self.text.append(content)
+    ignorableWhitespace = characters
+    def get_string(self):
+        return self.buffer.getvalue() if self.buffer is not None else None
+
+class XMLFormatFilter(xml.sax.handler.ContentHandler):
+    """Sends a document to base as xslt/format-xml.xsl would.
+
+    Troff elements are removed, leaving the elements inside them, and an error
+    is raised if a troff element directly contains text or more than one other
+    element.  Namespaces are declared the way the XSLT processor declares them
+    when copying: those declared on the element itself, then those the element
+    and its attributes need, unless the binding is already in scope.
+
+    Events are passed on as they arrive, so memory use doesn't grow with the
+    document.  The document is only started on base once there is something
+    to send, so an error before the first element leaves nothing behind, but
+    unlike with the XSLT processor, a later error leaves the output so far.
+    """
+    def __init__(self, base):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.base = base
+        # Each entry is a list of whether the element is a troff element,
+        # whether it is being sent to base, the number of other elements it
+        # directly contains and the prefixes it declared with their previous
+        # bindings.
+        self.stack = []
+        self.pending = []
+        self.bindings = {"xml": NS_XML, None: ""}
+        # The number of open elements other than troff elements.
+        self.copied = 0
+        self.emit = True
+        self.done = False
+        self.started = False
+    def _start(self):
+        if not self.started:
+            self.started = True
+            self.base.startDocument()
+    def startDocument(self):
+        pass
+    def endDocument(self):
+        self._start()
+        self.base.endDocument()
+    def startPrefixMapping(self, prefix, uri):
+        self.pending.append((prefix, uri))
+    def endPrefixMapping(self, prefix):
+        pass
+    def _declare(self, prefix, uri, declared):
+        old = self.bindings.get(prefix)
+        if old != uri:
+            declared.append((prefix, old))
+            self.bindings[prefix] = uri
+            self.base.startPrefixMapping(prefix, uri)
+    def startElementNS(self, name, qname, attrs):
+        nsdefs = self.pending
+        self.pending = []
+        parent = self.stack[-1] if self.stack else None
+        is_troff = name[0] == NS_TROFF
+        if parent is not None and parent[0] and not is_troff:
+            parent[2] += 1
+            if parent[2] > 1:
+                raise FilterError("multiple root elements not allowed")
+        if is_troff:
+            self.stack.append([True, False, 0, ()])
+            return
+        if not self.copied:
+            # Only the first top-level element is output, since the XSLT
+            # result is a single tree.
+            self.emit = not self.done
+        self.copied += 1
+        if not self.emit:
+            self.stack.append([False, False, 0, ()])
+            return
+        self._start()
+        declared = []
+        for prefix, uri in nsdefs:
+            self._declare(prefix, uri, declared)
+        prefix, sep, local = qname.partition(":")
+        self._declare(prefix if sep else None, name[0] or "", declared)
+        for aname in attrs.getNames():
+            if aname[0]:
+                prefix = attrs.getQNameByName(aname).partition(":")[0]
+                self._declare(prefix, aname[0], declared)
+        self.stack.append([False, True, 0, declared])
+        self.base.startElementNS(name, qname, attrs)
+    def endElementNS(self, name, qname):
+        (is_troff, emit, count, declared) = self.stack.pop()
+        if is_troff:
+            return
+        self.copied -= 1
+        if not self.copied:
+            self.done = True
+        if not emit:
+            return
+        self.base.endElementNS(name, qname)
+        for prefix, uri in reversed(declared):
+            self.base.endPrefixMapping(prefix)
+            self.bindings[prefix] = uri
+    def characters(self, content):
+        if not content or not self.stack:
+            return
+        entry = self.stack[-1]
+        if entry[0]:
+            raise FilterError("stray text not allowed")
+        if entry[1]:
+            self.base.characters(content)
+    ignorableWhitespace = characters
+    def processingInstruction(self, target, data):
+        self._start()
+        self.base.processingInstruction(target, data)
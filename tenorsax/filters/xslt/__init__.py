@@ -1,53 +1,108 @@
 import codecs
-import io
-import sys
-import xml.sax
-import xml.sax.saxutils
-import xml.sax.xmlreader
+import os
+import threading
 
 import lxml.etree
+import lxml.sax
+
+_stylesheets = {}
+_stylesheets_lock = threading.Lock()
+
+_XSL_OUTPUT = "{http://www.w3.org/1999/XSL/Transform}output"
+
+def _output_encoding(doc):
+    """Return the output encoding a stylesheet names, or None."""
+    for elem in doc.getroot().iterfind(_XSL_OUTPUT):
+        if elem.get("encoding"):
+            return elem.get("encoding")
+    return None
+
+def _load_stylesheet(path):
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _stylesheets_lock:
+        entry = _stylesheets.get(path)
+        if entry is None or entry[0] != stamp:
+            doc = lxml.etree.parse(path)
+            entry = (stamp, lxml.etree.XSLT(doc), _output_encoding(doc))
+            _stylesheets[path] = entry
+        return entry
+
+def compile_stylesheet(path):
+    """Return the compiled XSLT stylesheet at path.
+
+    Compiled stylesheets are kept for as long as the file is unchanged, so a
+    process converting several documents compiles each stylesheet only once.
+    """
+    return _load_stylesheet(path)[1]
 
 class GenericXSLTTransformer:
+    """Builds a document from SAX events and transforms it with a stylesheet.
+
+    Events are fed straight into an lxml tree builder, so the document is never
+    serialized before being transformed.  Once the document has ended, the
+    result of the transformation is available from get_tree; subclasses
+    additionally write it somewhere.
+    """
     def __init__(self, stylesheet):
         self.loc = stylesheet
-        parsed = lxml.etree.parse(self.loc)
-        self.transform = lxml.etree.XSLT(parsed)
-        self.docbuf = io.StringIO()
-        self.writer = xml.sax.saxutils.XMLGenerator(self.docbuf, "UTF-8")
-    def _get_string(self):
-        self.writer.endDocument()
-        # lxml.etree refuses to read XML documents with an encoding declaration
-        # from strings, so we have to convert it to bytes in order to get it to
-        # parse correctly.
-        sbuf = self.docbuf.getvalue()
-        c = codecs.getencoder("UTF-8")
-        bbuf = c(sbuf)[0]
-        doc = lxml.etree.parse(io.BytesIO(bbuf))
-        return str(self.transform(doc))
-        print(str(result), file=sys.stderr)
-        parsebuf = io.StringIO(str(result))
-        self.reader.parse(parsebuf)
+        (self.transform, self.encoding) = _load_stylesheet(self.loc)[1:]
+        self.builder = lxml.sax.ElementTreeContentHandler()
+        self.result = None
+    def _transform(self):
+        self.builder.endDocument()
+        self.result = self.transform(self.builder.etree)
+        return self.result
+    def characters(self, content):
+        # The tree builder would turn an empty string into an empty text node,
+        # which a serialized document cannot contain.
+        if content:
+            self.builder.characters(content)
+    ignorableWhitespace = characters
+    def endDocument(self):
+        self._transform()
+    def get_tree(self):
+        """Return the result of the transformation as an lxml ElementTree."""
+        return self.result
     def __getattr__(self, name):
-        return getattr(self.writer, name)
+        return getattr(self.builder, name)
 
 class TextXSLTTransformer(GenericXSLTTransformer):
+    """Writes the result of the transformation to a text stream.
+
+    If output is backed by a binary buffer and uses the encoding named by the
+    stylesheet, the result is serialized straight into the buffer.
+    """
     def __init__(self, output, stylesheet):
         GenericXSLTTransformer.__init__(self, stylesheet)
         self.output = output
     def endDocument(self):
-        self.s = self._get_string()
-        if self.output is not None:
-            self.output.write(self.s)
+        result = self._transform()
+        if self.output is None:
+            return
+        buf = getattr(self.output, "buffer", None)
+        if buf is None or not self._same_encoding():
+            self.output.write(str(result))
+            return
+        self.output.flush()
+        result.write_output(buf)
+        buf.flush()
+    def _same_encoding(self):
+        encoding = getattr(self.output, "encoding", None)
+        if encoding is None or self.encoding is None:
+            return False
+        try:
+            return (codecs.lookup(encoding).name ==
+                    codecs.lookup(self.encoding).name)
+        except LookupError:
+            return False
     def get_string(self):
-        return self.s
+        return str(self.result)
 
 class XSLTTransformer(GenericXSLTTransformer):
+    """Sends the result of the transformation as SAX events to base."""
     def __init__(self, base, stylesheet):
         GenericXSLTTransformer.__init__(self, stylesheet)
         self.base = base
-        self.reader = xml.sax.make_parser()
-        self.reader.setContentHandler(self.base)
     def endDocument(self):
-        s = self._get_string()
-        parsebuf = io.StringIO(s)
-        self.reader.parse(parsebuf)
+        lxml.sax.saxify(self._transform(), self.base)
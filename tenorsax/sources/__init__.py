@@ -32,55 +32,201 @@ class Quote:
         self.tag = tag
         self.simple = not unconstrained
 
+# Markup tokens produced by QuoteParser.
+START_INLINE = "start"
+END_INLINE = "end"
+
 class QuoteParser:
-    """Transforms quotes in text into a tagged format."""
-    def __init__(self, quotes):
+    """Transforms quotes in text into a list of tokens.
+
+    Each token is either a string of text or a pair of START_INLINE or
+    END_INLINE and the tag of a quote.  Quotes, and optionally backslash
+    escapes, character entities and the sequences in a replacement table, are
+    all handled in one pass from left to right.  Escaped characters, entities
+    and replacements become the characters they stand for and can't start or
+    end a quote.
+    """
+    _entity = re.compile(r"&#(x[A-Fa-f0-9]+|\d+);")
+    _attrlist = re.compile(r"\[[^[\]]+?\]")
+    _word = re.compile(r"\w")
+    def __init__(self, quotes, replacements=None, escapes=False,
+            entities=False):
         """Create a new quote parser.
 
         quotes is a sequence of Quotes to be recognized, with priority given to
-        elements earlier in the list.
+        elements earlier in the list.  replacements maps sequences to the code
+        points of the characters replacing them; where sequences overlap, the
+        longest wins.  If escapes is true, a backslash escapes the following
+        character, and if entities is true, numeric character entities are
+        replaced.
         """
         self._quotes = quotes
-
+        self._escapes = escapes
+        self._entities = entities
+        self._replacements = replacements or {}
+        # Quotes that may be opened or closed at a character, in priority
+        # order.
+        self._openers = {}
+        self._closers = {}
+        special = set()
+        for i, q in enumerate(quotes):
+            self._openers.setdefault(q.lq[0], []).append((i, q.lq))
+            self._closers.setdefault(q.rq[0], []).append((i, q.rq))
+            special.update((q.lq[0], q.rq[0]))
+        if quotes:
+            special.add("[")
+        if escapes:
+            special.add("\\")
+        if entities:
+            special.add("&")
+        self._replace = None
+        if self._replacements:
+            seqs = sorted(self._replacements, key=len, reverse=True)
+            self._replace = re.compile("|".join(re.escape(x) for x in seqs))
+            special.update(x[0] for x in seqs)
+        self._special = re.compile("[" + re.escape("".join(sorted(special))) +
+                "]")
+    def _can_open(self, text, start, end, quote, atom_end):
+        """Return whether quote may open at start, with content at end."""
+        if end >= len(text):
+            return False
+        if quote.simple:
+            if start > 0 and start != atom_end:
+                c = text[start-1]
+                if c in ";:}" or self._word.match(c):
+                    return False
+            if text[end].isspace():
+                return False
+        return True
+    def _can_close(self, text, start, end, quote, content, atom_end):
+        """Return whether quote, with content from content, may close here."""
+        if start <= content:
+            return False
+        if not quote.simple:
+            return True
+        if text[start-1].isspace() and start != atom_end:
+            return False
+        return end >= len(text) or not self._word.match(text, end)
     def parse(self, text):
-        """Process any quotes in this text and replace them with tags."""
-        for q in self._quotes:
-            lq = q.lq
-            rq = q.rq
-            tag = q.tag
-            if not q.simple:
-                # Unconstrained quotes can appear anywhere.
-                reo = re.compile(r'(?msu)(^|.)(\[(?P<attrlist>[^[\]]+?)\])?' +
-                        r'(?:' + re.escape(lq) + r')' +
-                        r'(?P<content>.+?)(?:'+re.escape(rq)+r')')
-            else:
-                # The text within constrained quotes must be bounded by white
-                # space.  Non-word (\W) characters are allowed at boundaries to
-                # accomodate enveloping quotes and punctuation e.g. a='x',
-                # ('x'), 'x', ['x'].
-                reo = re.compile(r'(?msu)(^|[^\w;:}])' +
-                    r'(\[(?P<attrlist>[^[\]]+?)\])?' +
-                    r'(?:' + re.escape(lq) + r')' +
-                    r'(?P<content>\S|\S.*?\S)(?:'+re.escape(rq)+r')(?=\W|$)')
-            pos = 0
-            while True:
-                mo = reo.search(text, pos)
-                if not mo:
+        """Process any quotes in this text and return the tokens."""
+        quotes = self._quotes
+        out = []
+        # Each entry is the quote, the index of its start tag in out, the text
+        # to put back if it is never closed and where its content starts.
+        stack = []
+        open_at = [[] for q in quotes]
+        # Where each closing delimiter last appears in the text.
+        last = {}
+        atom_end = -1
+        pos = 0
+        n = len(text)
+        while True:
+            mo = self._special.search(text, pos)
+            if mo is None:
+                if pos < n:
+                    out.append(text[pos:])
+                break
+            i = mo.start()
+            if i > pos:
+                out.append(text[pos:i])
+            c = text[i]
+            pos = i + 1
+            if c == "\\" and self._escapes:
+                if i + 1 < n and text[i+1] != "\n":
+                    out.append(text[i+1])
+                    pos = atom_end = i + 2
+                    continue
+            if c == "&" and self._entities:
+                m = self._entity.match(text, i)
+                if m is not None:
+                    val = m.group(1)
+                    code = int(val[1:], 16) if val[0] == "x" else int(val)
+                    out.append(chr(code))
+                    pos = atom_end = m.end()
+                    continue
+            if self._replace is not None:
+                m = self._replace.match(text, i)
+                if m is not None:
+                    out.append(chr(self._replacements[m.group()]))
+                    pos = atom_end = m.end()
+                    continue
+            best = None
+            for q, rq in self._closers.get(c, ()):
+                if (open_at[q] and text.startswith(rq, i) and
+                        (best is None or open_at[q][-1] > best[0]) and
+                        self._can_close(text, i, i + len(rq), quotes[q],
+                            stack[open_at[q][-1]][3], atom_end)):
+                    best = (open_at[q][-1], rq)
+            if best is not None:
+                (depth, rq) = best
+                while len(stack) > depth + 1:
+                    (q, idx, revert, content) = stack.pop()
+                    open_at[q].pop()
+                    out[idx] = revert
+                (q, idx, revert, content) = stack.pop()
+                open_at[q].pop()
+                tag = quotes[q].tag
+                out[idx] = (START_INLINE, tag)
+                out.append((END_INLINE, tag))
+                pos = i + len(rq)
+                continue
+            start = i
+            if c == "[":
+                m = self._attrlist.match(text, i)
+                if m is None or m.end() >= n:
+                    out.append(c)
+                    continue
+                # Attribute lists are not used, but are removed along with
+                # the quote they precede.
+                i = m.end()
+            for q, lq in self._openers.get(text[i], ()):
+                # A constrained quote doesn't nest inside itself; its
+                # delimiter is either the closing one or text.
+                if quotes[q].simple and open_at[q]:
+                    continue
+                end = i + len(lq)
+                rq = quotes[q].rq
+                if rq not in last:
+                    last[rq] = text.rfind(rq)
+                # A quote that can't be closed isn't opened, so that one of
+                # lower priority gets a chance here instead.
+                if (last[rq] > end and text.startswith(lq, i) and
+                        self._can_open(text, start, end, quotes[q], atom_end)):
+                    open_at[q].append(len(stack))
+                    stack.append((q, len(out), text[start:end], end))
+                    out.append(None)
+                    pos = end
                     break
-                if text[mo.start()] == '\\':
-                    # Delete leading backslash.
-                    text = text[:mo.start()] + text[mo.start()+1:]
-                    # Skip past start of match.
-                    pos = mo.start() + 1
-                else:
-                    attrlist = {}
-                    #parse_attributes(mo.group('attrlist'), attrlist)
-                    stag = ''.join(["<i-", tag, ">"])
-                    etag = ''.join(["</i-", tag, ">"])
-                    s = mo.group(1) + stag + mo.group('content') + etag
-                    text = text[:mo.start()] + s + text[mo.end():]
-                    pos = mo.start() + len(s)
-        return text
+            else:
+                out.append(c)
+        for (q, idx, revert, content) in stack:
+            out[idx] = revert
+        return out
+
+class LineClassifier:
+    """Classifies lines of a document using precompiled patterns.
+
+    rules is a sequence of (type, chars, pattern) triples, where chars holds the
+    characters a line of that type can start with.  Only the rules for the
+    first character of a line are tried, in order, so classifying a line costs
+    about the same no matter how many rules there are.  Lines that are empty or
+    all whitespace are of type "blank".
+    """
+    def __init__(self, rules):
+        self._rules = {}
+        for type_, chars, pattern in rules:
+            reo = re.compile(pattern)
+            for c in chars:
+                self._rules.setdefault(c, []).append((type_, reo))
+    def classify(self, line):
+        """Return the type of line and the match, or None and None."""
+        if not line or line.isspace():
+            return ("blank", None)
+        for type_, reo in self._rules.get(line[0], ()):
+            mo = reo.match(line)
+            if mo is not None:
+                return (type_, mo)
+        return (None, None)
 
 class Metadata:
     def __init__(self):
@@ -98,6 +244,8 @@ class FancyTextParser(xml.sax.xmlreader.XMLReader):
     PREFIX = "_tmarkup"
     def __init__(self, ch=None):
         self.ch = ch
+        self.trace = trace_from_environment()
+        self.lines = iter(())
         self.dh = None
         self.enth = None
         self.eh = None
@@ -109,38 +257,58 @@ class FancyTextParser(xml.sax.xmlreader.XMLReader):
             for ak, av in attrs.items():
                 if type(ak) is list or type(ak) is tuple:
                     attritems[(ak[0], ak[1])] = av
-                    qnameitems[ak[2]] = av
+                    qnameitems[(ak[0], ak[1])] = ak[2]
                 else:
                     attritems[(None, ak)] = av
-                    qnameitems[ak] = av
+                    qnameitems[(None, ak)] = ak
             a = xml.sax.xmlreader.AttributesNSImpl(attritems, qnameitems)
         else:
             a = xml.sax.xmlreader.AttributesNSImpl({}, {})
         self.ch.startElementNS((self.NS, name), self.PREFIX + ":" + name, a)
     def _end_element(self, name):
         self.ch.endElementNS((self.NS, name), self.PREFIX + ":" + name)
-    def _process_tags(self, text):
-        """Emits a tagged text to the ContentHandler."""
-        reo = re.compile(r"<(/?)(\w)-([^/>]+)(/?)>")
-        pos = 0
-        while True:
-            mo = reo.search(text, pos)
-            if not mo:
-                break
-            is_end = mo.group(1) == "/"
-            tagtype = mo.group(2)
-            tagname = mo.group(3)
-            is_sc = mo.group(4) == "/"
-            self.ch.characters(text[pos:mo.start()])
-            if tagtype == "c":
-                self.ch.characters(chr(int(tagname[1:], 16)))
-            elif tagtype in "i":
-                if not is_sc and not is_end:
-                    self._start_element("inline", {"type": tagname})
-                elif not is_sc:
-                    self._end_element("inline")
-            pos = mo.end()
-        self.ch.characters(text[pos:])
+    def _process_inline(self, tokens):
+        """Emits the tokens produced by a QuoteParser to the ContentHandler."""
+        text = []
+        for token in tokens:
+            if type(token) is str:
+                if token:
+                    text.append(token)
+                continue
+            if text:
+                self.ch.characters("".join(text))
+                text = []
+            if token[0] == START_INLINE:
+                self._start_element("inline", {"type": token[1]})
+            else:
+                self._end_element("inline")
+        if text:
+            self.ch.characters("".join(text))
+    def _next_line(self):
+        # Raises StopIteration at the end of the document.
+        return next(self.lines)
+    def _handle_title_line(self, line, mo):
+        """Handle a line that may underline the previous one as a title.
+
+        mo is the match for the line if it is an underline.  Return the level
+        of the title, or None if it isn't one.
+        """
+        if self.trace & TRACE_MARKUP:
+            trace(self, TRACE_MARKUP, "title-line", char=line[0])
+        try:
+            prev_line = self.data.pop()
+        except IndexError:
+            return None
+        l = len(prev_line)
+        # Allow give or take two characters.
+        if mo is None or not l - 2 <= len(mo.group(1)) <= l + 2:
+            self.data.append(prev_line)
+            self.data.append(line)
+            return None
+        else:
+            idx = self.TITLE_CHARS.index(line[0])
+            self._start_section(idx, prev_line, line)
+            return idx
     def _generate_metadata(self, meta):
         self._start_element("meta")
         self._start_element("generator", {"name": "TenorSax",
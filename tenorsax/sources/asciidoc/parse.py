@@ -23,7 +23,8 @@ import tenorsax.sources
 import xml.sax.xmlreader
 
 from tenorsax.util import *
-from tenorsax.sources import FancyTextParser, Quote, QuoteParser
+from tenorsax.sources import (FancyTextParser, LineClassifier, Quote,
+        QuoteParser)
 
 class AsciiDocStateError(tenorsax.sources.FancyTextParserStateError):
     pass
@@ -42,6 +43,43 @@ class AuthorParser:
 
 class AsciiDocParser(FancyTextParser):
     TITLE_CHARS = "=-~^+"
+    QUOTES = [
+        Quote("**", "**", "strong", True),
+        Quote("*", "*", "strong"),
+        Quote("``", "''", "quote"),
+        Quote("'", "'", "emphasis"),
+        Quote("`", "'", "quote"),
+        Quote("+++", "+++", "span", True),
+        Quote("$$", "$$", "span", True),
+        Quote("++", "++", "monospace", True),
+        Quote("+", "+", "monospace"),
+        Quote("__", "__", "emphasis", True),
+        Quote("_", "_", "emphasis"),
+        Quote("##", "##", "span", True),
+        Quote("#", "#", "span"),
+        Quote("^", "^", "superscript", True),
+        Quote("~", "~", "subscript", True)
+    ]
+    REPLACEMENTS = {
+        "(C)": 0xa9,
+        "(TM)": 0x2122,
+        "(R)": 0xae,
+        "--": 0x2014,
+        "...": 0x2026,
+        "->": 0x2192,
+        "<-": 0x2190,
+        "=>": 0x21d2,
+        "<=": 0x21d0
+    }
+    inline = QuoteParser(QUOTES, REPLACEMENTS, escapes=True, entities=True)
+    LINES = LineClassifier([
+        # A single line comment, not a comment block.
+        ("comment", "/", r"//(?!/)"),
+        ("block-style", "[", r"\[(.*)\]$"),
+        # One-line titles.
+        ("title", "=", r"(={1,5})\s+(.*\S*)\s+\1\s*$"),
+        ("underline", TITLE_CHARS, r"(=+|-+|~+|\^+|\++)$"),
+    ])
     def __init__(self, ch = None):
         super().__init__(ch)
         self.state = AsciiDocStateConstants.START
@@ -49,124 +87,26 @@ class AsciiDocParser(FancyTextParser):
         self.data = []
         self.inlines = []
         self.metadata = tenorsax.sources.Metadata()
-        self.lines = []
-    @staticmethod
-    def _process_quotes(text):
-        """Process any quotes in this text and replace them with tags."""
-        tags = [
-            Quote("**", "**", "strong", True),
-            Quote("*", "*", "strong"),
-            Quote("``", "''", "quote"),
-            Quote("'", "'", "emphasis"),
-            Quote("`", "'", "quote"),
-            Quote("+++", "+++", "span", True),
-            Quote("$$", "$$", "span", True),
-            Quote("++", "++", "monospace", True),
-            Quote("+", "+", "monospace"),
-            Quote("__", "__", "emphasis", True),
-            Quote("_", "_", "emphasis"),
-            Quote("##", "##", "span", True),
-            Quote("#", "#", "span"),
-            Quote("^", "^", "superscript", True),
-            Quote("~", "~", "subscript", True)
-        ]
-        parser = QuoteParser(tags)
-        return parser.parse(text)
-    @staticmethod
-    def _preprocess_for_tagging(text):
-        """Converts angle brackets into tags."""
-        replacements = {
-            "<": 0x3c,
-            ">": 0x3e,
-            "(C)": 0xa9,
-            "(TM)": 0x2122,
-            "(R)": 0xae,
-            "--": 0x2014,
-            "...": 0x2026,
-            "->": 0x2192,
-            "<-": 0x2190,
-            "=>": 0x21d2,
-            "<=": 0x21d0
-        }
-        def make_char(c):
-            return "<c-u" + c + "/>"
-        def repl_bs(mo):
-            return make_char(hex(ord(mo.group(1))))
-        def repl_seq(mo):
-            log("group:", mo.group(0))
-            return make_char(hex(replacements[mo.group(1)]))
-        def repl_ent(mo):
-            if mo.group(1)[0] == "x":
-                return make_char(mo.group(1)[1:])
-            else:
-                return make_char(hex(int(mo.group(1))))
-        text = re.sub(r"\\(.)", repl_bs, text)
-        text = re.sub(r"([<>]|\((C|TM|R)\)|--|\.\.\.|->|<-|=>|<=)", repl_seq,
-                text)
-        return re.sub(r"&#(x[A-Fa-f0-9]+|\d+);", repl_ent, text)
     def _process_text(self, text):
-        text = self._preprocess_for_tagging(text)
-        text = self._process_quotes(text)
-        self._process_tags(text)
-    def _handle_title_line(self, line):
-        log("start of line is title char", line[0])
-        try:
-            prev_line = self.data.pop()
-        except IndexError:
-            return None
-        l = len(prev_line)
-        # Allow give or take two characters.
-        pat = r"{0}{1}{3},{4}{2}$".format("\\" + line[0], "{", "}",
-                l - 2, l + 2)
-        m = re.match(pat, line)
-        if m is None:
-            self.data.append(prev_line)
-            self.data.append(line)
-            return None
-        else:
-            idx = self.TITLE_CHARS.index(line[0])
-            self._start_section(idx, prev_line, line)
-            return idx
-    def _parse_style(self, line):
-        mo = re.match(r"^\[(.*)\]$", line)
-        if mo is None:
-            return None
-        return re.split(r",\s*", mo.group(1))
-    def _get_line_type(self, line):
-        if re.match("^\s*$", line):
-            return "blank"
-        elif self._parse_style(line):
-            return "block-style"
-        else:
-            return None
-    def _next_line(self):
-        try:
-            return self.lines.pop(0)
-        except IndexError:
-            raise StopIteration
+        self._process_inline(self.inline.parse(text))
     def _do_state_machine(self):
         k = AsciiDocStateConstants
         line = self._next_line()
         self.state = k.START
         while True:
-            linetype = self._get_line_type(line)
-            # A single line comment, not a comment block.
-            if line.startswith("//") and line[2] != "/":
+            (linetype, mo) = self.LINES.classify(line)
+            if linetype == "comment":
                 line = self._next_line()
                 continue
             if self.state == k.START:
                 if linetype == "block-style":
                     raise NotImplementedError
-                elif line[0] in "=":
-                    # One-line titles.
-                    m = re.match(r"(={1,5})\s+(.*\S*)\s+\1\s*$", line)
-                    if m is None:
-                        self.state = k.TEXT_LINE
-                        self._generate_metadata(self.metadata)
-                        self.data.append(line)
-                    else:
-                        l = len(m.group(1))
-                        self._start_section(l, m.group(2))
+                elif linetype == "title":
+                    self._start_section(len(mo.group(1)), mo.group(2))
+                elif line[0] == "=":
+                    self.state = k.TEXT_LINE
+                    self._generate_metadata(self.metadata)
+                    self.data.append(line)
                 else:
                     self.state = k.HEADER_LINE
                     self.data.append(line)
@@ -176,8 +116,8 @@ class AsciiDocParser(FancyTextParser):
                     self._flush()
                     self.state = k.PARA_START
                 elif line[0] in self.TITLE_CHARS:
-                    level = self._handle_title_line(line)
-                    log("section title in header line")
+                    level = self._handle_title_line(line,
+                            mo if linetype == "underline" else None)
                     if level != 0:
                         self.state = k.PARA_START
                 else:
@@ -192,8 +132,8 @@ class AsciiDocParser(FancyTextParser):
                 if linetype == "block-style":
                     raise NotImplementedError
                 elif line[0] in self.TITLE_CHARS:
-                    self._handle_title_line(line)
-                    log("section title in text line")
+                    self._handle_title_line(line,
+                            mo if linetype == "underline" else None)
                 elif linetype == "blank":
                     if self.state == k.IN_PARA:
                         self._flush()
@@ -213,7 +153,8 @@ class AsciiDocParser(FancyTextParser):
             else:
                 raise NotImplementedError
             line = self._next_line()
-            log("next line; current state:", self.state)
+            if self.trace & TRACE_MARKUP:
+                trace(self, TRACE_MARKUP, "state", state=self.state)
     def _flush_text(self):
         self._process_text(''.join(self.data))
         self.data = []
@@ -231,7 +172,6 @@ class AsciiDocParser(FancyTextParser):
             raise AsciiDocStateError("Only one para at a time, please")
         self.ch.ignorableWhitespace("\n")
         self._start_element("para")
-        log("start_para: state is", self.state)
     def _start_section(self, level, title, line = None):
         title = chomp(title)
         if self.state == AsciiDocStateConstants.IN_PARA:
@@ -278,7 +218,7 @@ class AsciiDocParser(FancyTextParser):
         self.ch.startPrefixMapping(self.PREFIX, self.NS)
         self._start_element("root")
         self.ch.ignorableWhitespace("\n")
-        self.lines = [l for l in source]
+        self.lines = iter(source)
         try:
             self._do_state_machine()
         except StopIteration:
@@ -20,7 +20,7 @@ import tenorsax.sources
 import xml.sax.xmlreader
 
 from tenorsax.util import *
-from tenorsax.sources import FancyTextParser, Quote, QuoteParser
+from tenorsax.sources import FancyTextParser, LineClassifier
 
 class MarkdownStateError(tenorsax.sources.FancyTextParserStateError):
     pass
@@ -29,36 +29,21 @@ MarkdownStateConstants = tenorsax.sources.FancyTextParserStateConstants
 
 class MarkdownParser(FancyTextParser):
     TITLE_CHARS = "=-"
+    LINES = LineClassifier([
+        # One-line titles.
+        ("title", "#", r"(#{1,5})\s+(.*?\S*)(\s+#+)?\s*$"),
+        ("underline", TITLE_CHARS, r"(=+|-+)$"),
+    ])
+    COMMENT_START = re.compile(r"^(.*)<!--\s((?:.*?\s|)-->)?(.*)$")
+    COMMENT_END = re.compile(r"^.*?\s-->(.*)$")
     def __init__(self, ch = None):
         super().__init__(ch)
         self.data = []
         self.level = 0
         self.inlines = []
-    def _handle_title_line(self, line):
-        log("start of line is title char", line[0])
-        try:
-            prev_line = self.data.pop()
-        except IndexError:
-            return None
-        l = len(prev_line)
-        # Allow give or take two characters.
-        pat = r"{0}{1}{3},{4}{2}$".format("\\" + line[0], "{", "}",
-                l - 2, l + 2)
-        m = re.match(pat, line)
-        if m is None:
-            self.data.append(prev_line)
-            self.data.append(line)
-            return None
-        else:
-            idx = self.TITLE_CHARS.index(line[0])
-            self._start_section(idx, prev_line, line)
-            return idx
-    @staticmethod
-    def _preprocess_for_tagging(text):
-        return text
     def _process_text(self, text):
-        text = self._preprocess_for_tagging(text)
-        self._process_tags(text)
+        if text:
+            self.ch.characters(text)
     def _flush_text(self):
         self._process_text(''.join(self.data))
         self.data = []
@@ -71,19 +56,11 @@ class MarkdownParser(FancyTextParser):
             self._end_element("para")
             self.state = MarkdownStateConstants.PARA_START
         self.ch.ignorableWhitespace("\n")
-    def _get_line_type(self, line):
-        if re.match("^\s*$", line):
-            return "blank"
-        else:
-            return None
-    def _next_line(self):
-        try:
-            return self.lines.pop(0)
-        except IndexError:
-            raise StopIteration
     def _handle_comments(self, line):
         k = MarkdownStateConstants
-        mobj = re.match("^(.*)<!--\s((?:.*?\s|)-->)?(.*)$", line)
+        if "<!--" not in line:
+            return line
+        mobj = self.COMMENT_START.match(line)
         if mobj is None:
             return line
         if mobj.group(2) is None:
@@ -97,25 +74,25 @@ class MarkdownParser(FancyTextParser):
         line = self._next_line()
         self.state = k.START
         while True:
-            linetype = self._get_line_type(line)
-            line = self._handle_comments(line)
+            (linetype, mo) = self.LINES.classify(line)
+            kind = linetype
+            uncommented = self._handle_comments(line)
+            if uncommented != line:
+                line = uncommented
+                (kind, mo) = self.LINES.classify(line)
             if self.state == k.START:
                 if linetype == "block-style":
                     raise NotImplementedError
-                elif line[0] in "#":
-                    # One-line titles.
-                    m = re.match(r"(#{1,5})\s+(.*?\S*)(\s+#+)?\s*$", line)
-                    if m is None:
-                        self.state = k.TEXT_LINE
-                        self.data.append(line)
-                    else:
-                        l = len(m.group(1))
-                        self._start_section(l, m.group(2))
+                elif kind == "title":
+                    self._start_section(len(mo.group(1)), mo.group(2))
+                elif line[0] == "#":
+                    self.state = k.TEXT_LINE
+                    self.data.append(line)
                 else:
                     self.state = k.HEADER_LINE
                     self.data.append(line)
             elif self.state == k.IN_COMMENT or self.state == k.IN_PARA_COMMENT:
-                mobj = re.match("^.*?\s-->(.*)$", line)
+                mobj = self.COMMENT_END.match(line)
                 if mobj is not None:
                     self.data.append(self._handle_comments(mobj.group(1)))
                     self.state = k.IN_PARA if self.state == k.IN_PARA_COMMENT else k.PARA_START
@@ -124,7 +101,8 @@ class MarkdownParser(FancyTextParser):
                     self._flush()
                     self.state = k.PARA_START
                 elif line[0] in self.TITLE_CHARS:
-                    level = self._handle_title_line(line)
+                    level = self._handle_title_line(line,
+                            mo if kind == "underline" else None)
                     if level != 0:
                         self.state = k.PARA_START
                 else:
@@ -139,8 +117,8 @@ class MarkdownParser(FancyTextParser):
                 if linetype == "block-style":
                     raise NotImplementedError
                 elif len(line) and line[0] in self.TITLE_CHARS:
-                    self._handle_title_line(line)
-                    log("section title in text line")
+                    self._handle_title_line(line,
+                            mo if kind == "underline" else None)
                 elif linetype == "blank":
                     if self.state == k.IN_PARA:
                         self._flush()
@@ -154,29 +132,25 @@ class MarkdownParser(FancyTextParser):
                 elif linetype == "blank":
                     self._start_para()
                     self.state = k.IN_PARA
+                elif kind == "title":
+                    self._start_section(len(mo.group(1)), mo.group(2))
                 elif len(line) and line[0] == "#":
-                    # One-line titles.
-                    m = re.match(r"(#{1,5})\s+(.*?\S*)(\s+#+)?\s*$", line)
-                    if m is None:
-                        self.state = k.IN_PARA
-                        self.data.append(line)
-                        self._start_para()
-                    else:
-                        l = len(m.group(1))
-                        self._start_section(l, m.group(2))
+                    self.state = k.IN_PARA
+                    self.data.append(line)
+                    self._start_para()
                 else:
                     self.state = k.HEADER_LINE
                     self.data.append(line)
             else:
                 raise NotImplementedError
             line = self._next_line()
-            log("next line; current state:", self.state)
+            if self.trace & TRACE_MARKUP:
+                trace(self, TRACE_MARKUP, "state", state=self.state)
     def _start_para(self, type_ = None):
         if self.state == MarkdownStateConstants.IN_PARA:
             raise MarkdownStateError("Only one para at a time, please")
         self.ch.ignorableWhitespace("\n")
         self._start_element("para")
-        log("start_para: state is", self.state)
     def _start_section(self, level, title, line = None):
         title = chomp(title)
         if self.state == MarkdownStateConstants.IN_PARA:
@@ -211,7 +185,7 @@ class MarkdownParser(FancyTextParser):
         self.ch.startPrefixMapping(self.PREFIX, self.NS)
         self._start_element("root")
         self.ch.ignorableWhitespace("\n")
-        self.lines = [l for l in source]
+        self.lines = iter(source)
         try:
             self._do_state_machine()
         except StopIteration:
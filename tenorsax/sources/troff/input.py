@@ -0,0 +1,295 @@
+import codecs
+import collections
+import io
+import mmap
+import sys
+
+class InputStack:
+    """A pushback stack of input segments for the troff lexer.
+
+    Injected text is pushed as a whole string together with an offset instead
+    of being split into individual characters, so injecting a macro body costs
+    the same no matter how long it is.  The segment currently being read is
+    kept in attributes of its own; segments it interrupted are kept on a stack
+    below it.
+
+    A segment may be pushed as a frame, in which case a callable is placed on
+    the stack beneath it.  The callable is run as soon as the last character of
+    the frame, including anything pushed while it was being read, has been
+    consumed.
+
+    Each segment may also have an owner, the object it was obtained from, which
+    is available as the owner attribute while that segment is being read.
+
+    A FileSource may be pushed as well; its text is read a string at a time
+    as it is needed, and the file being read is available as the file
+    attribute, with the line being read given by location.  If on_file is not
+    None, it is called with the file whenever a different file is entered or
+    resumed.
+
+    Beneath everything else is an optional source, an iterator of strings
+    which is only advanced once all the pushed text has been read.  This lets
+    the lexer pull its input lazily instead of needing all of it up front.  The
+    source may also produce FileSources, which are read as if pushed.  Reading
+    past the end of the input raises IndexError.
+    """
+    def __init__(self, data="", source=None):
+        self.text = ""
+        self.pos = 0
+        self.end = 0
+        self.owner = None
+        self.stack = []
+        self.source = source
+        self.file = None
+        self.on_file = None
+        self.push(data)
+    def push(self, s, frame=None, owner=None):
+        """Push s so that it is read before any remaining input.
+
+        If frame is not None, it is called once s has been read.
+        """
+        if not s:
+            return
+        if self.pos < self.end:
+            self.stack.append((self.text, self.pos, self.owner))
+        if frame is not None:
+            self.stack.append(frame)
+        self.text = s
+        self.pos = 0
+        self.end = len(s)
+        self.owner = owner
+    def push_source(self, source):
+        """Push the FileSource source so that it is read next."""
+        if self.pos < self.end:
+            self.stack.append((self.text, self.pos, self.owner))
+        self.stack.append(source)
+        self.text = ""
+        self.pos = 0
+        self.end = 0
+        self.owner = None
+        source.parent = self.file
+        self._set_file(source)
+    def _set_file(self, source):
+        self.file = source
+        if source is not None and self.on_file is not None:
+            self.on_file(source)
+    def location(self):
+        """Return the name of the file being read and the current line.
+
+        The line is that of the last character consumed from the file.  If no
+        file is being read, return None.
+        """
+        f = self.file
+        if f is None:
+            return None
+        chunk = f.chunk
+        pos = len(chunk)
+        if self.text is chunk:
+            pos = self.pos
+        else:
+            for item in reversed(self.stack):
+                if type(item) is tuple and item[0] is chunk:
+                    pos = item[1]
+                    break
+        return (f.name, f.line(pos - 1))
+    def _fill(self):
+        """Make the next string from the source current."""
+        s = next(self.source, None) if self.source is not None else None
+        if s is None:
+            raise IndexError("end of input")
+        if type(s) is FileSource:
+            self.push_source(s)
+            return
+        self.text = s
+        self.pos = 0
+        self.end = len(s)
+        self.owner = None
+    def _load(self):
+        """Make the next nonempty segment current."""
+        while self.pos >= self.end:
+            if not self.stack:
+                self._fill()
+                continue
+            item = self.stack.pop()
+            if type(item) is tuple:
+                self.text, self.pos, self.owner = item
+                self.end = len(self.text)
+            elif type(item) is FileSource:
+                s = item.next_chunk()
+                if s is None:
+                    self._set_file(item.parent)
+                    continue
+                self.stack.append(item)
+                self.text = s
+                self.pos = 0
+                self.end = len(s)
+                self.owner = None
+            else:
+                item()
+    def _end_frames(self):
+        """Close all frames that end with the current segment."""
+        stack = self.stack
+        while stack:
+            t = type(stack[-1])
+            if t is tuple or t is FileSource:
+                break
+            stack.pop()()
+    def peek(self):
+        """Return the next character without consuming it."""
+        if self.pos >= self.end:
+            self._load()
+        return self.text[self.pos]
+    def read(self):
+        """Consume and return the next character."""
+        pos = self.pos
+        if pos >= self.end:
+            self._load()
+            pos = self.pos
+        self.pos = pos + 1
+        if self.pos == self.end and self.stack:
+            self._end_frames()
+        return self.text[pos]
+    def peek_run(self, stops):
+        """Return the text up to the first character in stops.
+
+        Only the current segment is examined, so the result may stop short of
+        the next stop character.  Nothing is consumed.
+        """
+        if self.pos >= self.end:
+            try:
+                self._load()
+            except IndexError:
+                return ""
+        text = self.text
+        pos = self.pos
+        end = self.end
+        for c in stops:
+            i = text.find(c, pos, end)
+            if i != -1:
+                end = i
+        return text[pos:end]
+    def skip(self, n):
+        """Consume n characters of the current segment."""
+        if n == 0:
+            return
+        self.pos += n
+        if self.pos == self.end and self.stack:
+            self._end_frames()
+    def read_run(self, stops):
+        """Consume and return the text up to the first character in stops."""
+        s = self.peek_run(stops)
+        self.skip(len(s))
+        return s
+
+class FileSource:
+    """The contents of a file, read lazily, along with where they came from.
+
+    chunks is an iterator of strings; if it is None, the file named by name is
+    read with read_file.  While the file is being read, chunk is the string
+    being read and lines is the number of lines in the strings before it.
+    """
+    __slots__ = ("name", "chunks", "chunk", "lines", "parent")
+    def __init__(self, name, chunks=None):
+        self.name = name
+        self.chunks = iter(read_file(name) if chunks is None else chunks)
+        self.chunk = ""
+        self.lines = 0
+        self.parent = None
+    def next_chunk(self):
+        """Make the next string current and return it, or None at the end."""
+        self.lines += self.chunk.count("\n")
+        s = next(self.chunks, None)
+        self.chunk = s if s is not None else ""
+        return s
+    def line(self, pos):
+        """Return the number of the line containing position pos of chunk."""
+        return self.lines + self.chunk.count("\n", 0, max(pos, 0)) + 1
+
+class FeedSource:
+    """A source for an InputStack whose data is supplied as it arrives.
+
+    Data is handed out only in complete lines, so a lexer reading from this
+    source never sees half a line.  Until close is called, running out of data
+    means the lexer must wait instead of having reached the end of the input.
+    """
+    def __init__(self):
+        self.lines = collections.deque()
+        self.partial = ""
+        self.closed = False
+    def __iter__(self):
+        return self
+    def __next__(self):
+        try:
+            return self.lines.popleft()
+        except IndexError:
+            raise StopIteration
+    def feed(self, data):
+        data = self.partial + data
+        i = data.rfind("\n") + 1
+        if i:
+            self.lines.append(data[:i])
+        self.partial = data[i:]
+    def close(self):
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ""
+        self.closed = True
+    def starved(self):
+        """Return True if no data is available yet but more is expected."""
+        return not self.closed and not self.lines
+
+def read_file(path, encoding="UTF-8", blocksize=1 << 16):
+    """Return an iterator over the contents of the file at path as strings.
+
+    The file is opened immediately, so a missing file raises OSError here
+    rather than when the contents are first needed.  Regular files are
+    memory-mapped and decoded a block at a time, so only one block of the file
+    needs to be held as a string at once.  Other files, such as pipes, are
+    read normally.  Line endings are translated as they would be for a file
+    opened in text mode.  A path of "-" means standard input.
+    """
+    if path == "-":
+        fp = open(sys.stdin.fileno(), "rb", closefd=False)
+    else:
+        fp = open(path, "rb")
+    return _FileReader(fp, _read_blocks(fp, encoding, blocksize))
+
+class _FileReader:
+    """An iterator over blocks read from fp that closes it when discarded.
+
+    A generator only closes the file once it has started running, so this
+    takes care of files that are opened but never read.
+    """
+    __slots__ = ("fp", "blocks")
+    def __init__(self, fp, blocks):
+        self.fp = fp
+        self.blocks = blocks
+    def __iter__(self):
+        return self
+    def __next__(self):
+        return next(self.blocks)
+    def close(self):
+        self.blocks.close()
+        self.fp.close()
+    def __del__(self):
+        self.close()
+
+def _read_blocks(fp, encoding, blocksize):
+    decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(encoding)(), True)
+    with fp:
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and pipes can't be mapped.
+            data = None
+        if data is not None:
+            with data:
+                for i in range(0, len(data), blocksize):
+                    yield decoder.decode(data[i:i+blocksize])
+        else:
+            block = fp.read(blocksize)
+            while block:
+                yield decoder.decode(block)
+                block = fp.read(blocksize)
+    yield decoder.decode(b"", True)
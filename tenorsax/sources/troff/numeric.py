@@ -1,14 +1,19 @@
 import decimal
+import operator
 
-from tenorsax.util import log
+from tenorsax.util import TRACE_NUMERIC, trace
 
 class NumberRegister:
+    __slots__ = ("state", "name", "val", "inc", "fmt")
     def __init__(self, state, name, val, increment, fmt):
         self.state = state
         self.name = name
+        self.set(val, increment)
+        self.fmt = fmt
+    def set(self, val, increment):
+        """Change the value and increment of the register in place."""
         self.val = self.func(val)
         self.inc = self.func(increment)
-        self.fmt = fmt
     def increment(self):
         self.val += self.inc
     def decrement(self):
@@ -19,6 +24,13 @@ class NumberRegister:
         elif inc == 1:
             self.increment()
         return str(self)
+    def number(self, inc=0):
+        """Like value, but return the value as a number."""
+        if inc == -1:
+            self.decrement()
+        elif inc == 1:
+            self.increment()
+        return self.val
     def __call__(self, state):
         self.state = state
         return self
@@ -26,9 +38,11 @@ class NumberRegister:
         return str(self.val)
 
 class IntegerNumberRegister(NumberRegister):
+    __slots__ = ()
     func = staticmethod(int)
 
 class FloatNumberRegister(NumberRegister):
+    __slots__ = ()
     func = staticmethod(decimal.Decimal)
     def __str__(self):
         if self.val.to_integral_value() == self.val:
@@ -39,6 +53,7 @@ class FloatNumberRegister(NumberRegister):
         return str(self.val)
 
 class SpecialNumberRegister(NumberRegister):
+    __slots__ = ("callback",)
     def __init__(self, state, name, callback):
         self.state = state
         self.name = name
@@ -49,14 +64,203 @@ class SpecialNumberRegister(NumberRegister):
         pass
     def value(self, inc=0):
         return str(self)
+    def number(self, inc=0):
+        return self.callback(self)
     def __call__(self, state):
         self.state = state
         return self
     def __str__(self):
         return str(self.callback(self))
 
+def _argument_count(reg):
+    macroargs = reg.state.macroargs
+    return len(macroargs[-1])-1 if len(macroargs) else 0
+
 def initialize_registers(state):
     regs = {}
-    regs[".$"] = SpecialNumberRegister(state, ".$", lambda x:
-            len(x.state.macroargs[-1])-1 if len(x.state.macroargs) else 0)
+    regs[".$"] = SpecialNumberRegister(state, ".$", _argument_count)
     return regs
+
+def _divide(n1, n2):
+    """Divide, truncating toward zero as troff does."""
+    if not n2:
+        return 0
+    if type(n1) is int and type(n2) is int:
+        q = abs(n1) // abs(n2)
+        return q if (n1 < 0) == (n2 < 0) else -q
+    return n1 // n2
+
+def _modulo(n1, n2):
+    """Take the remainder of a division truncated toward zero."""
+    if not n2:
+        return 0
+    return n1 - n2 * _divide(n1, n2)
+
+OPERATORS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": _divide,
+    "%": _modulo,
+    "&": lambda n1, n2: int(bool(n1 and n2)),
+    ":": lambda n1, n2: int(bool(n1 or n2)),
+    "<": lambda n1, n2: int(n1 < n2),
+    "<=": lambda n1, n2: int(n1 <= n2),
+    ">": lambda n1, n2: int(n1 > n2),
+    ">=": lambda n1, n2: int(n1 >= n2),
+    "=": lambda n1, n2: int(n1 == n2),
+    "==": lambda n1, n2: int(n1 == n2),
+    "<>": lambda n1, n2: int(n1 != n2),
+    "<?": min,
+    ">?": max,
+}
+
+class RegisterReference:
+    """A use of a number register, with \\n, within an expression."""
+    def __init__(self, name, increment):
+        self.name = name
+        self.increment = increment
+    def evaluate(self, state):
+        try:
+            reg = state.numregs[self.name](state)
+        except KeyError:
+            return 0
+        val = reg.number(self.increment)
+        if state.trace & TRACE_NUMERIC:
+            trace(state, TRACE_NUMERIC, "register", name=self.name,
+                    increment=self.increment, value=val)
+        return val
+
+class Expression:
+    """A compiled numeric expression.
+
+    terms is a list of (operator, operand, negated) triples, the first of which
+    has no operator.  Operators are applied strictly from left to right, as in
+    troff.  An operand is either a number or an object with an evaluate method,
+    such as a RegisterReference or a parenthesized Expression.
+
+    Integer literals are kept as ints; only literals with a decimal point are
+    Decimals, so expressions not involving them are evaluated entirely with
+    ints.  An expression with no register references is evaluated once, when
+    it is compiled.
+    """
+    def __init__(self, terms):
+        self.terms = terms
+        self.constant = None
+        if all(isinstance(t[1], (int, decimal.Decimal)) for t in terms):
+            self.constant = self.evaluate(None)
+    def evaluate(self, state):
+        if self.constant is not None:
+            return self.constant
+        val = 0
+        for (op, operand, negated) in self.terms:
+            if not isinstance(operand, (int, decimal.Decimal)):
+                operand = operand.evaluate(state)
+            if negated:
+                operand = -operand
+            val = operand if op is None else op(val, operand)
+        return val
+
+class _ExpressionCompiler:
+    DIGITS = "0123456789."
+
+    def __init__(self, text, ec, extended):
+        self.text = text
+        self.pos = 0
+        self.ec = ec
+        self.extended = extended
+    def _peek(self):
+        return self.text[self.pos] if self.pos < len(self.text) else ""
+    def _next(self):
+        c = self._peek()
+        self.pos += 1
+        return c
+    def expression(self):
+        terms = []
+        op = None
+        while True:
+            (operand, negated) = self._operand()
+            terms.append((op, operand, negated))
+            op = None
+            while op is None:
+                c = self._peek()
+                if not c or c == ")":
+                    return Expression(terms)
+                op = self._operator()
+    def _operator(self):
+        c = self._next()
+        if c in "<>=" and c + self._peek() in OPERATORS:
+            c += self._next()
+        # Anything that isn't an operator, such as a scale indicator, is
+        # ignored.
+        return OPERATORS.get(c)
+    def _operand(self):
+        negated = False
+        c = self._peek()
+        while c in ("+", "-"):
+            negated ^= c == "-"
+            self.pos += 1
+            c = self._peek()
+        if c == "(":
+            self.pos += 1
+            operand = self.expression()
+            self._next()
+            if operand.constant is not None:
+                operand = operand.constant
+        elif c and c == self.ec:
+            self.pos += 1
+            operand = self._register()
+        else:
+            start = self.pos
+            while self._peek() and self._peek() in self.DIGITS:
+                self.pos += 1
+            operand = self._number(self.text[start:self.pos])
+        return (operand, negated)
+    def _register(self):
+        if self._next() != "n":
+            raise ValueError("only \\n escapes can be compiled")
+        increment = 0
+        if self._peek() in ("+", "-"):
+            increment = -1 if self._next() == "-" else 1
+        c = self._next()
+        if c == "(":
+            name = self._next() + self._next()
+        elif c == "[" and self.extended:
+            end = self.text.find("]", self.pos)
+            if end == -1:
+                raise ValueError("unterminated register name")
+            name = self.text[self.pos:end]
+            self.pos = end + 1
+        else:
+            name = c
+        return RegisterReference(name, increment)
+    @staticmethod
+    def _number(s):
+        if "." not in s:
+            return int(s) if s else 0
+        try:
+            return decimal.Decimal(s)
+        except decimal.InvalidOperation:
+            return 0
+
+_expressions = {}
+
+def compile_expression(text, ec="\\", extended=False):
+    """Compile the numeric expression in text, or return None if it can't be.
+
+    Only \\n escapes may appear in text; other escapes must have been
+    interpolated already.  Compiled expressions are cached by their text.
+    """
+    key = (text, ec, extended)
+    try:
+        return _expressions[key]
+    except KeyError:
+        pass
+    try:
+        expr = _ExpressionCompiler(text, ec, extended).expression()
+    except ValueError:
+        expr = None
+    if len(_expressions) >= 4096:
+        _expressions.clear()
+    _expressions[key] = expr
+    return expr
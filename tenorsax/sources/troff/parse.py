@@ -1,29 +1,30 @@
-import decimal
+import codecs
 import io
 import os
-import re
 import string
 import sys
 import xml.sax.xmlreader
 
 from xml.sax.xmlreader import AttributesNSImpl as Attributes
 
+import tenorsax.sources.troff.numeric
 import tenorsax.sources.troff.requests
 import tenorsax.sources.troff.stringlike
 
 from tenorsax.util import *
+from tenorsax.sources.troff.input import FeedSource, FileSource, InputStack
+from tenorsax.sources.troff.stringlike import (F_TERMINAL, F_NAME, F_NUMERIC,
+        F_INCREMENTAL, F_CONDITIONAL, F_EXECUTABLE)
 
 class StackDepthExceededError(Exception):
     pass
 
 class Environment:
+    __slots__ = ("cc", "c2", "ec", "fill", "fonts")
     def __init__(self):
         self.cc = '.'
         self.c2 = "'"
         self.ec = '\\'
-        self.sdelim = "\U00102204"
-        self.edelim = "\U00102206"
-        self.fdelim = "\U00102205"
         self.fill = True
         self.fonts = [1, 1]
 
@@ -34,46 +35,51 @@ class ParsingError(Exception):
         return self.reason
 
 class ParseObject:
+    __slots__ = ()
     def invoke(self, lp):
         pass
     def postparse(self):
         pass
 
 class JunkData(ParseObject):
+    __slots__ = ()
     def __init__(self, state, *args):
         pass
     def __str__(self):
         return ""
 
 class CharacterData(ParseObject):
+    """A line of text.
+
+    data is a sequence of pieces, each of which is either a string or an
+    inline escape, such as a font change, which takes effect between the
+    surrounding pieces of text.
+    """
+    __slots__ = ("state", "data")
     def __init__(self, state, *data):
         self.state = state
-        self.data = "".join(data)
+        self.data = []
+        text = ""
+        for piece in data:
+            if type(piece) is str:
+                text += piece
+            else:
+                self.data.extend((text, piece))
+                text = ""
+        self.data.append(text)
     def invoke(self, lp):
-        env = self.state.env[0]
-        pat = re.compile(''.join(["(", env.sdelim, "[^", env.edelim, "]+",
-            env.edelim, ")"]))
-        items = pat.split(self.data)
-        while True:
-            if len(items) == 1:
-                if items[0]:
-                    self.state.ch.characters(items[0])
-                break
+        for piece in self.data:
+            if type(piece) is str:
+                if piece:
+                    self.state.ch.characters(piece)
             else:
-                text = items.pop(0)
-                code = items.pop(0)[1:-1]
-                insn = code[0]
-                code = code[1:]
-                if text:
-                    self.state.ch.characters(text)
-                if insn == "x":
-                    args = code.split(env.fdelim)
-                    req = NonBreakingInvocable(self.state, *args)
-                    req.invoke(lp)
+                piece.invoke(lp)
     def __str__(self):
-        return self.data
+        return "".join(str(piece) for piece in self.data
+                if type(piece) is str)
 
 class Escape(ParseObject):
+    __slots__ = ("state", "name", "text")
     def __init__(self, state, name):
         self.state = state
         self.name = name
@@ -83,6 +89,9 @@ class Escape(ParseObject):
     def executable(self):
         """Return True if this escape delimits a block of code."""
         return False
+    def inline(self):
+        """Return True if this escape is kept in text as a token."""
+        return False
     @staticmethod
     def _escape(c):
         if c == '"':
@@ -101,19 +110,20 @@ class Escape(ParseObject):
             return "[" + name + "]"
 
 class StringEscape(Escape):
+    __slots__ = ()
     def __init__(self, state, name):
         super().__init__(state, name)
         self.state = state
         self.name = name
     def __str__(self):
         try:
-            s = self._escape(str(self.state.requests[self.name](self.state)))
-            log("esc", self.name, "==", s)
+            s = self._escape(str(self.state.requests[self.name]))
             return s
         except Exception as e:
             return ""
 
 class ConditionalEscape(Escape):
+    __slots__ = ("is_start",)
     def __init__(self, state, is_start):
         self.state = state
         self.is_start = is_start
@@ -124,16 +134,18 @@ class ConditionalEscape(Escape):
 
 # FIXME: not implemented properly
 class ArgumentEscape(Escape):
+    __slots__ = ("item",)
     def __init__(self, state, item):
         self.state = state
         self.item = item
     def __str__(self):
         try:
-            return self._escape(str(self.state.requests[self.name](self.state)))
+            return self._escape(str(self.state.requests[self.name]))
         except Exception as e:
             return ""
 
 class NumericEscape(Escape):
+    __slots__ = ("increment", "reg", "val")
     def __init__(self, state, name, increment):
         self.state = state
         self.name = name
@@ -145,17 +157,18 @@ class NumericEscape(Escape):
             if self.val is None:
                 self.reg = self.state.numregs[self.name](self.state)
                 self.val = self.reg.value(self.increment)
-            log("name", self.name)
-            log("reg", self.reg, self.increment)
-            log("regv", self.val)
-            s = str(self.val)
-            log("regs", s)
-            return s
+            if self.state.trace & TRACE_NUMERIC:
+                trace(self.state, TRACE_NUMERIC, "register", name=self.name,
+                        increment=self.increment, value=self.val)
+            return str(self.val)
         except Exception as e:
-            log(e)
+            if self.state.trace & TRACE_NUMERIC:
+                trace(self.state, TRACE_NUMERIC, "register-error",
+                        name=self.name, error=e)
             return "0"
 
 class DelayedEscape(Escape):
+    __slots__ = ("data",)
     def __init__(self, state, data):
         self.state = state
         self.data = data
@@ -164,7 +177,29 @@ class DelayedEscape(Escape):
     def __str__(self):
         return self.data
 
+class FontEscape(Escape):
+    """A font change.
+
+    In text, this is kept as a token among the text and changes the font when
+    the text is output.  Elsewhere, it reads as its original spelling, which
+    is delayed so that it takes effect once the text is used.
+    """
+    __slots__ = ("spelling",)
+    def __init__(self, state, name, spelling):
+        self.state = state
+        self.name = name
+        self.spelling = spelling
+    def delay(self):
+        return 1
+    def inline(self):
+        return True
+    def invoke(self, lp):
+        NonBreakingInvocable(self.state, "ft", self.name).invoke(lp)
+    def __str__(self):
+        return self.spelling
+
 class CharacterEscape(Escape):
+    __slots__ = ("data",)
     def __init__(self, state, data):
         self.state = state
         self.data = data
@@ -172,6 +207,7 @@ class CharacterEscape(Escape):
         return self.data
 
 class Comment(Escape):
+    __slots__ = ("data",)
     def __init__(self, state, data):
         self.state = state
         self.data = data
@@ -179,9 +215,11 @@ class Comment(Escape):
         return ""
 
 class NumericNamespacedParseObject(ParseObject):
+    __slots__ = ()
     pass
 
 class StringNamespacedParseObject(ParseObject):
+    __slots__ = ("state", "name", "args", "brk")
     def __init__(self, state, name, *args):
         self.state = state
         self.name = name
@@ -191,6 +229,7 @@ class StringNamespacedParseObject(ParseObject):
         pass
 
 class Macro(StringNamespacedParseObject):
+    __slots__ = ()
     def __init__(self, state, name, *args):
         self.state = state
         self.name = name
@@ -198,29 +237,39 @@ class Macro(StringNamespacedParseObject):
         self.brk = True
 
 class Invocable(StringNamespacedParseObject):
+    __slots__ = ()
     def invoke(self, lp):
         res = None
+        prof = self.state.profiler if self.name else None
+        depth = lp.recursion
         try:
             if self.name not in self.state.requests:
                 s = tenorsax.sources.troff.stringlike.StringData(self.state, "")
                 self.state.requests[self.name] = s
-                trace(self.state, TRACE_UNDEF, "request", self.name,
-                    "is not defined")
-            res = self.state.requests[self.name](self.state).execute(self)
+                trace(self.state, TRACE_UNDEF, "undefined", name=self.name)
+            impl = self.state.requests[self.name]
+            if prof is not None:
+                prof.enter(self.name, type(impl).__name__)
+            res = impl.execute(self)
         except StopIteration:
             raise
         except Exception:
             pass
-        if res is not None:
-            (s, callinfo) = res
-            args = None
-            if callinfo is not None:
-                args = [callinfo.name]
-                args.extend(callinfo.args)
-            lp.inject(s, args)
+        try:
+            if res is not None:
+                (s, callinfo) = res
+                args = None
+                if callinfo is not None:
+                    args = [callinfo.name]
+                    args.extend(callinfo.args)
+                lp.inject(s, args)
+        finally:
+            # A macro's frame lasts until its body has been processed.
+            if prof is not None and lp.recursion == depth:
+                prof.leave()
     def postparse(self):
         try:
-            self.state.requests[self.name](self.state).postparse()
+            self.state.requests[self.name].postparse()
         except Exception as e:
             pass
     def __str__(self):
@@ -228,52 +277,17 @@ class Invocable(StringNamespacedParseObject):
                 self.args)
 
 class BreakingInvocable(Invocable):
+    __slots__ = ()
     def __init__(self, *args):
         Invocable.__init__(self, *args)
         self.brk = True
 
 class NonBreakingInvocable(Invocable):
+    __slots__ = ()
     def __init__(self, *args):
         Invocable.__init__(self, *args)
         self.brk = False
 
-def calculate(n1, op, n2):
-    """Evaluate a binary numeric expression."""
-    # NB: this does not use eval even where it might be shorter or cleaner to
-    # avoid any sort of arbitrary code execution.
-    if op == '+':
-        return n1 + n2
-    elif op == '-':
-        return n1 - n2
-    elif op == '*':
-        return n1 * n2
-    elif op == '/':
-        return n1 // n2
-    elif op == '%':
-        return n1 % n2
-    elif op == '&':
-        return int(bool(n1 and n2))
-    elif op == ':':
-        return int(bool(n1 or n2))
-    elif op == '<':
-        return int(n1 < n2)
-    elif op == '<=':
-        return int(n1 <= n2)
-    elif op == '>':
-        return int(n1 > n2)
-    elif op == '>=':
-        return int(n1 >= n2)
-    elif op == '=' or op == '==':
-        return int(n1 == n2)
-    elif op == '<>':
-        return int(n1 != n2)
-    elif op == '<?':
-        return min(n1, n2)
-    elif op == '>?':
-        return max(n1, n2)
-    else:
-        raise ValueError("undefined operation")
-
 class LineParserStateConstants:
     START = 0
     IN_REQNAME = 1
@@ -299,85 +313,131 @@ class LineParserStateConstants:
     IN_EXECUTABLEDELAY = 21
 
 class LineParser:
-    """Parses troff input line-by-line."""
-    def __init__(self, state, line):
+    """Parses troff input line-by-line.
+
+    line is text to be parsed first; source, if given, is an iterator of
+    strings which is read lazily once that text has been consumed.
+    """
+    def __init__(self, state, line, source=None):
         self.state = state
-        self.data = list(reversed(line))
-        self.chartrap = []
+        self.data = InputStack(line, source)
+        self.data.on_file = self._enter_file
         self.request = False
         self.brk = False
         self.name = None
         self.curreq = None
+        self.curflags = ()
+        self.curmax = 0
         self.recursion = 0
+        self.line_depth = 0
     def append(self):
         self.items.append(self.ctxt)
         ctxt = ""
     def _set_request_name(self, reqname):
         self.items.append(reqname)
-        try:
-            self.curreq = self.state.requests[reqname](self.state)
-            self.curreq.preparse()
-        except KeyError:
-            pass
+        req = self.state.requests.get(reqname)
+        if req is not None:
+            self.curreq = req
+            self.curflags = req.arg_flags
+            self.curmax = req.max_args
+            req.preparse()
+    def _cur_flags(self):
+        """Return the flags for the argument being parsed."""
+        i = len(self.items) - 1
+        flags = self.curflags
+        return flags[i] if i < len(flags) else 0
     def _cur_is_long_last_arg(self):
-        try:
-            return self.curreq.arg_flags(len(self.items)-1) & self.curreq.F_TERMINAL
-        except AttributeError:
-            return False
+        return self._cur_flags() & F_TERMINAL
     def _cur_is_name_arg(self):
-        try:
-            return self.curreq.arg_flags(len(self.items)-1) & self.curreq.F_NAME
-        except AttributeError:
-            return False
+        return self._cur_flags() & F_NAME
     def _cur_is_numeric(self):
-        try:
-            return self.curreq.arg_flags(len(self.items)-1) & self.curreq.F_NUMERIC
-        except AttributeError:
-            return False
+        return self._cur_flags() & F_NUMERIC
     def _cur_is_incremental(self):
-        try:
-            return self.curreq.arg_flags(len(self.items)-1) & self.curreq.F_INCREMENTAL
-        except AttributeError:
-            return False
+        return self._cur_flags() & F_INCREMENTAL
     def _cur_is_executable(self):
-        try:
-            return self.curreq.arg_flags(len(self.items)-1) & self.curreq.F_EXECUTABLE
-        except AttributeError:
-            return False
+        return self._cur_flags() & F_EXECUTABLE
     def _cur_is_conditional(self):
-        try:
-            return self.curreq.arg_flags(len(self.items)-1) & self.curreq.F_CONDITIONAL
-        except AttributeError:
-            return False
+        return self._cur_flags() & F_CONDITIONAL
     def _peek_next_character(self):
-        return self.data[-1]
+        return self.data.peek()
     def _next_character(self):
-        c = self.data.pop()
-        if len(self.chartrap) != 0:
-            self.chartrap[-1] -= 1
-            if self.chartrap[-1] == 0:
-                log("chartrap", len(self.chartrap), "sprung")
-                self.chartrap.pop()
-                self.state.macroargs.pop()
-                self.recursion -= 1
-        return c
+        return self.data.read()
+    def _peek_next_run(self, *stops):
+        """Return the text up to the next character in stops.
+
+        The text returned never extends past the end of the current segment, so
+        it may be shorter than expected.
+        """
+        return self.data.peek_run(stops)
+    def _skip_characters(self, n):
+        """Consume n characters previously returned by _peek_next_run."""
+        self.data.skip(n)
+    def _next_run(self, *stops):
+        """Consume and return the text up to the next character in stops."""
+        return self.data.read_run(stops)
+    def _end_frame(self):
+        if self.state.trace & TRACE_FRAME:
+            trace(self.state, TRACE_FRAME, "frame-end", depth=self.recursion)
+        self.state.macroargs.pop()
+        self.recursion -= 1
+    def _enter_file(self, source):
+        self.state.filename = source.name
     def inject(self, more, args=None):
+        if type(more) is FileSource:
+            self.data.push_source(more)
+            return
         s = str(more)
-        self.data.extend(reversed(list(s)))
-        if args is not None:
+        owner = None
+        if isinstance(more, tenorsax.sources.troff.stringlike.MacroData):
+            owner = more
+        if args is not None and s:
             self.recursion += 1
-            log("recursion limit is %d (%d) for args %s" % (self.state.recursion,
-                self.recursion, args))
             if self.recursion > self.state.recursion:
                 raise StackDepthExceededError(("recursion %d is greater " +
                 "than limit %d") % (self.recursion, self.state.recursion))
-            self.chartrap.append(len(s))
             self.state.macroargs.append(args)
-            log("inserting trap", len(self.chartrap), "for", len(s))
-            log("trap", len(self.chartrap), "is", len(args), args)
-        elif len(self.chartrap) != 0:
-            log("expanding trap", len(self.chartrap), "by", len(s))
-            self.chartrap[-1] += len(s)
+            self.data.push(s, self._end_frame, owner)
+            if self.state.trace & TRACE_FRAME:
+                trace(self.state, TRACE_FRAME, "frame-start",
+                        depth=self.recursion, args=args)
+        else:
+            self.data.push(s, None, owner)
+    def _lex_key(self):
+        """Return everything other than the text that affects lexing a line."""
+        env = self.state.env[0]
+        return (env.cc, env.c2, env.ec, env.fill, self.state.get_flags())
+    def _lexed_line(self):
+        """Look up the line being read in its macro's cache.
+
+        This is called with the first character of the line already read.  On
+        a hit, the rest of the line is consumed, self.items is filled in and
+        the kind of the line is returned along with None.  Otherwise, None is
+        returned along with what is needed to store the line once it has been
+        lexed, or None if it cannot be cached.
+        """
+        data = self.data
+        text = data.text
+        start = data.pos - 1
+        key = self._lex_key()
+        line = data.owner.get_lexed(key, start)
+        if line is not None:
+            (kind, items, end) = line
+            data.skip(end - data.pos)
+            if issubclass(kind, Invocable):
+                self._set_request_name(items[0])
+                self.items.extend(items[1:])
+            else:
+                self.items = list(items)
+            return (kind, None)
+        end = text.find("\n", start, data.end)
+        if end == -1 or text.find(self.state.env[0].ec, start, end) != -1:
+            return (None, None)
+        return (None, (data.owner, key, start, text, end + 1))
+    def _store_lexed_line(self, record, kind):
+        """Cache a line described by a record from _lexed_line."""
+        (owner, key, start, text, end) = record
+        if self.data.text is text and self.data.pos == end:
+            owner.set_lexed(key, start, (kind, tuple(self.items), end))
     def _parse_escape_name(self):
         s = ""
         c = self._next_character()
@@ -389,7 +449,8 @@ class LineParser:
                     break
                 elif c == self.state.env[0].ec:
                     esc = self._parse_escape()
-                    self.inject(str(esc))
+                    if not esc.inline():
+                        self.inject(str(esc))
                 else:
                     s += c
                     cnt += 1
@@ -399,111 +460,75 @@ class LineParser:
             while c != "]" and not c.isspace():
                 if c == self.state.env[0].ec:
                     esc = self._parse_escape()
-                    self.inject(str(esc))
+                    if not esc.inline():
+                        self.inject(str(esc))
                 else:
                     s += c
                 c = self._next_character()
             return s
         else:
             return c
-    def _parse_numeric(self, pstate, c, nparens=0, inc=False):
-        """Parse a numerical expression and return its value."""
+    def _numeric_text(self, pstate, c):
+        """Read the text of a numeric expression starting with c.
+
+        Return the text and the state to continue in.  The character ending
+        the expression is consumed.  Where the expression lies entirely within
+        the current input segment and contains no escapes other than \\n, it
+        is taken as is, so that it can be compiled once and reused; otherwise,
+        it is read character by character with escapes interpolated.
+        """
         k = LineParserStateConstants
-        val = 0
-        curval = 0
-        stk = []
+        ec = self.state.env[0].ec
+        if c != "\n" and not c.isspace():
+            data = self.data
+            run = self._peek_next_run(" ", "\t", "\n")
+            text = c + run
+            # The ( of a two-character register name doesn't need closing.
+            opens = text.count("(") - sum(text.count(ec + "n" + inc + "(")
+                    for inc in ("", "+", "-"))
+            if (data.pos + len(run) < data.end and
+                    opens == text.count(")") and
+                    text.count(ec) == text.count(ec + "n")):
+                self._skip_characters(len(run))
+                c = self._next_character()
+                return (text, k.EOL if c == "\n" else pstate)
+        text = ""
+        nparens = 0
         delay = False
-        stnum = True
-        nctxt = ""
-        op = None
-        npstate = pstate
-        incchar = ""
-        if inc and c in "+-":
-            incchar = c
-            c = self._next_character()
         while True:
-            if c == '\n':
-                npstate = k.EOL
-                break
-            elif c == '(':
-                (npstate, val) = self._parse_numeric(pstate,
-                        self._next_character(), nparens+1, inc)
-                if npstate != pstate:
-                    break
-            elif c == ')':
-                if op is not None:
-                    val = calculate(val, op, curval)
-                npstate = pstate
-                break
-            elif c == self.state.env[0].ec and not delay:
+            if c == "\n":
+                return (text, k.EOL)
+            elif c == ec and not delay:
                 esc = self._parse_escape()
                 self.inject(esc)
                 if esc.delay():
                     delay = True
+                c = self._next_character()
+                continue
+            elif delay:
+                pass
             elif c.isspace():
                 if nparens == 0:
-                    pstate = k.SEPARATOR
-                    break
-            elif c in "0123456789.":
-                nctxt += c
-            elif c in "+-":
-                if len(nctxt) == 0:
-                    nctxt += c
-                else:
-                    try:
-                        curval = decimal.Decimal(nctxt)
-                    except ValueError:
-                        curval = 0
-                    nctxt = ""
-                    stk.append(curval)
-                    if len(stk) == 2:
-                        val = calculate(stk[0], op, stk[1])
-                        stk = []
-                    op = c
-            elif c in "*/%&:":
-                log("nctxt", nctxt)
-                try:
-                    curval = decimal.Decimal(nctxt)
-                except ValueError:
-                    curval = 0
-                nctxt = ""
-                stk.append(curval)
-                if len(stk) == 2:
-                    val = calculate(stk[0], op, stk[1])
-                    stk = []
-                op = c
-            elif c in "<>=":
-                try:
-                    curval = decimal.Decimal(nctxt)
-                except ValueError:
-                    curval = 0
-                nctxt = ""
-                stk.append(curval)
-                if len(stk) == 2:
-                    val = calculate(stk[0], op, stk[1])
-                    stk = []
-                op = c
-                c = self._next_character()
-                s = op + c
-                if s in ["==", "<>", "<?", ">?", "<=", ">="]:
-                    op = s
-                else:
-                    # don't read another character
-                    continue
+                    return (text, pstate)
+            else:
+                if c == "(":
+                    nparens += 1
+                elif c == ")":
+                    nparens -= 1
+                text += c
             c = self._next_character()
-            # FIXME: this is broken
             delay = False
-        try:
-            curval = decimal.Decimal(nctxt)
-        except:
-            curval = 0
-        stk.append(curval)
-        if len(stk) == 2:
-            val = calculate(stk[0], op, stk[1])
-        elif op is not None or len(nctxt) != 0:
-            val = stk[0]
-        if nparens == 0:
-            self.items.append(incchar + str(val))
+    def _parse_numeric(self, pstate, c, inc=False):
+        """Parse a numerical expression and return its value."""
+        incchar = ""
+        if inc and c in "+-":
+            incchar = c
+            c = self._next_character()
+        (text, npstate) = self._numeric_text(pstate, c)
+        expr = tenorsax.sources.troff.numeric.compile_expression(text,
+                self.state.env[0].ec, self.state.extended_names())
+        val = expr.evaluate(self.state) if expr is not None else 0
+        self.items.append(incchar + str(val))
         return (npstate, val)
 
     def _parse_escape(self, copy=False):
@@ -529,10 +554,10 @@ class LineParser:
         elif c == "t":
             return CharacterEscape(self.state, "\t")
         elif c in '#"':
+            s = self._next_run("\n")
             x = self._peek_next_character()
             while x != "\n":
-                self._next_character()
-                s += x
+                s += self._next_character() + self._next_run("\n")
                 x = self._peek_next_character()
             if c == "#":
                 self._next_character()
@@ -543,10 +568,7 @@ class LineParser:
         elif c == "$":
             try:
                 s = self._parse_escape_name()
-                log("escape name is", s)
                 n = int(s)
-                log("nmacroargs", len(self.state.macroargs))
-                log("nmacroargs set", len(self.state.macroargs[-1]))
                 return CharacterEscape(self.state, self.state.macroargs[-1][n])
             except Exception as e:
                 pass
@@ -555,11 +577,9 @@ class LineParser:
                 return DelayedEscape(self.state, self.state.env[0].ec + c)
             else:
                 if c == "f":
-                    # FIXME: implement correctly
                     name = self._parse_escape_name()
-                    env = self.state.env[0]
-                    text = env.sdelim + "xft" + env.fdelim + name + env.edelim
-                    return CharacterEscape(self.state, text)
+                    spelling = self.state.env[0].ec + c + Escape._gen_name(name)
+                    return FontEscape(self.state, name, spelling)
                 elif c in "{}":
                     return ConditionalEscape(self.state, c == "{")
         return CharacterEscape(self.state, "")
@@ -571,17 +591,17 @@ class LineParser:
         if c == "!":
             negation = True
             c = self._next_character()
-        if c == self.state.env[0].ec:
+        ec = self.state.env[0].ec
+        # Register references are left for the numeric expression compiler.
+        if c == ec and self._peek_next_character() != "n":
             esc = self._parse_escape()
             self.inject(esc)
             if esc.delay():
                 delay = True
             c = self._next_character()
-        log("condchar", c)
-        if c in "0123456789(+-":
+        if c in "0123456789(+-" or c == ec:
             (pstate, result) = self._parse_numeric(pstate, c)
             self.items.pop()
-            result = decimal.Decimal(result)
         elif c in "dr":
             condtype = c
             cur_s = ""
@@ -612,7 +632,6 @@ class LineParser:
             nsep = 1
             strs = []
             cur_s = ""
-            log("separator", sep)
             while True:
                 c = self._next_character()
                 if c == self.state.env[0].ec:
@@ -634,18 +653,23 @@ class LineParser:
                 else:
                     cur_s += c
                 delay = False
-            log("strings", strs[0], strs[1])
             result = strs[0] == strs[1]
             pstate = k.SEPARATOR
-        log("conditional result", result)
         result = result > 0
         if negation:
             result = not result
-        log("result", result)
+        if self.state.trace & TRACE_COND:
+            trace(self.state, TRACE_COND, "condition", result=result)
         self.items.append(result)
         return (pstate, result)
 
     def parse(self):
+        """Parse the input, yielding a ParseObject for each line.
+
+        If the source runs dry before the input has ended, as a FeedSource does
+        while waiting for more data, None is yielded instead; iteration may be
+        resumed once more data is available.
+        """
         env = self.state.env[0]
         ctxt = ""
         name = ""
@@ -654,12 +678,24 @@ class LineParser:
         k = LineParserStateConstants
         pstate = k.START
         nbraces = 0
+        data = self.data
+        starved = getattr(data.source, "starved", None)
+        record = None
         while True:
+            if (starved is not None and data.pos >= data.end and
+                    not data.stack and starved()):
+                yield None
+                continue
             c = self._next_character()
             if pstate == k.EOF:
                 raise StopIteration
             if pstate == k.START:
-                if self.state.copy_until is not None:
+                self.line_depth = self.recursion
+                if data.owner is not None and self.state.copy_until is None:
+                    (kind, record) = self._lexed_line()
+                if kind is not None:
+                    pstate = k.EOL
+                elif self.state.copy_until is not None:
                     kind = JunkData
                     pstate = k.IN_COPY
                 elif c == "\n":
@@ -675,15 +711,19 @@ class LineParser:
                     pstate = k.IN_REQNAME
                 elif c == env.ec:
                     esc = self._parse_escape()
-                    log("escape is", str(esc))
-                    self.inject(esc)
-                    if esc.delay():
+                    if esc.inline():
                         kind = CharacterData
-                        pstate = k.IN_TEXTDELAY
+                        pstate = k.IN_TEXT
+                        self.items.append(esc)
+                    else:
+                        self.inject(esc)
+                        if esc.delay():
+                            kind = CharacterData
+                            pstate = k.IN_TEXTDELAY
                 else:
                     kind = CharacterData
                     pstate = k.IN_TEXT
-                    ctxt += c
+                    ctxt += c + self._next_run(env.ec, "\n")
             elif pstate == k.IN_REQNAME or pstate == k.IN_REQNAMEDELAY:
                 if c == "\n":
                     self._set_request_name(name)
@@ -706,16 +746,26 @@ class LineParser:
                 else:
                     name += c
             elif pstate == k.SEPARATOR:
-                log("in separator", c)
                 if c == "\n":
                     self.items.append(ctxt)
                     ctxt = ""
                     pstate = k.EOL
                 elif self._cur_is_conditional():
                     pstate = self._parse_conditional(pstate, c)[0]
+                elif self._cur_is_numeric() and not c.isspace():
+                    inc = self._cur_is_incremental()
+                    pstate = self._parse_numeric(pstate, c, inc=inc)[0]
                 elif c == env.ec:
                     esc = self._parse_escape()
-                    log("sep escape is", str(esc))
+                    if esc.inline():
+                        # Keep the escape as written so that it takes effect
+                        # wherever the argument is used as text.
+                        ctxt += str(esc)
+                        if self._cur_is_executable():
+                            pstate = k.IN_EXECUTABLE
+                        else:
+                            pstate = k.IN_ARG
+                        continue
                     self.inject(esc)
                     if esc.delay():
                         kind = CharacterData
@@ -736,20 +786,14 @@ class LineParser:
                 elif self._cur_is_executable():
                     ctxt += c
                     pstate = k.IN_EXECUTABLE
-                elif self._cur_is_numeric():
-                    inc = self._cur_is_incremental
-                    pstate = self._parse_numeric(pstate, c, inc=inc)[0]
                 elif c == '"':
                     pstate = k.IN_QUOTEDARG
                 else:
-                    log("in separator", c)
                     pstate = k.IN_ARG
                     ctxt += c
             elif pstate == k.IN_EXECUTABLE or pstate == k.IN_EXECUTABLEDELAY:
-                log("nbraces", nbraces)
                 if c == env.ec and pstate == k.IN_EXECUTABLE:
                     esc = self._parse_escape()
-                    log("in executable", esc)
                     if esc.executable():
                         if esc.is_start:
                             nbraces += 1
@@ -769,14 +813,15 @@ class LineParser:
                     pstate = k.IN_EXECUTABLE
                     ctxt += c
             elif pstate == k.IN_ARG or pstate == k.IN_ARGDELAY:
-                log("in arg char is", c)
                 if c == "\n":
                     self.items.append(ctxt)
                     ctxt = ""
                     pstate = k.EOL
                 elif c == env.ec and pstate == k.IN_ARG:
                     esc = self._parse_escape()
-                    log("arg escape is", str(esc))
+                    if esc.inline():
+                        ctxt += str(esc)
+                        continue
                     self.inject(esc)
                     if esc.delay():
                         kind = CharacterData
@@ -784,15 +829,14 @@ class LineParser:
                 elif self._cur_is_long_last_arg():
                     ctxt += c
                 elif self._cur_is_numeric():
-                    inc = self._cur_is_incremental
+                    inc = self._cur_is_incremental()
                     pstate = self._parse_numeric(pstate, c, inc=inc)[0]
                 elif c.isspace():
-                    if self.curreq and len(self.items) == self.curreq.max_args():
+                    if len(self.items) == self.curmax:
                         ctxt += c
                     else:
                         self.items.append(ctxt)
                         ctxt = ""
-                        log("in arg space", self.items)
                         pstate = k.SEPARATOR
                 elif self._cur_is_name_arg() and not self.state.extended_names() and len(ctxt) == 2:
                     self.items.append(ctxt)
@@ -806,6 +850,9 @@ class LineParser:
                     pstate = k.EOL
                 elif c == env.ec and pstate == k.IN_QUOTEDARG:
                     esc = self._parse_escape()
+                    if esc.inline():
+                        ctxt += str(esc)
+                        continue
                     self.inject(esc)
                     if esc.delay():
                         kind = CharacterData
@@ -833,22 +880,32 @@ class LineParser:
                     pstate = k.EOL
                 elif c == env.ec:
                     esc = self._parse_escape()
-                    log("text escape is", str(esc))
-                    self.inject(esc)
-                    if esc.delay():
-                        pstate = k.IN_TEXTDELAY
+                    if esc.inline():
+                        if ctxt:
+                            self.items.append(ctxt)
+                            ctxt = ""
+                        self.items.append(esc)
+                    else:
+                        self.inject(esc)
+                        if esc.delay():
+                            pstate = k.IN_TEXTDELAY
                 else:
-                    ctxt += c
+                    # Most text contains no escapes, so take everything up to
+                    # the next special character at once.
+                    ctxt += c + self._next_run(env.ec, "\n")
             elif pstate == k.IN_TEXTDELAY:
                 if c == "\n":
                     if len(ctxt) == 0 or ctxt[-1] != "\u200b":
                         ctxt += " " if env.fill else "\n"
                     pstate = k.EOL
                 else:
-                    ctxt += c
+                    ctxt += c + self._next_run(env.ec, "\n")
                     pstate = k.IN_TEXT
             elif pstate == k.IN_COPY or pstate == k.IN_COPYDELAY:
                 # FIXME: Handle pecularities of copy mode
+                until = self.state.copy_until
+                if self.state.copy_start:
+                    until = until[1:]
                 if c == env.ec and pstate == k.IN_COPY:
                     esc = self._parse_escape(copy=True)
                     self.inject(esc)
@@ -857,14 +914,16 @@ class LineParser:
                 else:
                     ctxt += c
                     pstate = k.IN_COPY
-                until = self.state.copy_until
-                if self.state.copy_start:
-                    until = until[1:]
-                log("character is", c)
-                log("copy_start is", self.state.copy_start)
-                log("until is", until)
+                    # Take the text up to the next escape as one slice,
+                    # stopping short if the terminator occurs within it.
+                    run = self._peek_next_run(env.ec)
+                    tail = ctxt[-len(until):]
+                    i = (tail + run).find(until)
+                    if i != -1:
+                        run = run[:max(i + len(until) - len(tail), 0)]
+                    ctxt += run
+                    self._skip_characters(len(run))
                 if ctxt.endswith(until):
-                    log("endswith is True")
                     s = ctxt[:-len(until)] + "\n"
                     mdata = tenorsax.sources.troff.stringlike.MacroData(self.state, s)
                     if self.state.copy_to is not None:
@@ -877,13 +936,17 @@ class LineParser:
                     pstate = k.EOL
             if pstate == k.EOL:
                 self.state.copy_start = False
-                log("eol ctxt", ctxt)
                 if ctxt:
                     self.items.append(ctxt)
                 ctxt = ""
                 if kind is None:
-                    log(self.items)
                     raise ParsingError("unknown kind of data")
+                if record is not None:
+                    self._store_lexed_line(record, kind)
+                    record = None
+                if self.state.trace & TRACE_LEX:
+                    trace(self.state, TRACE_LEX, "line", kind=kind.__name__,
+                            items=self.items, location=self.data.location())
                 result = kind(self.state, *self.items)
                 more = (yield result)
                 result.postparse()
@@ -892,6 +955,8 @@ class LineParser:
                 kind = None
                 self.items = []
                 self.curreq = None
+                self.curflags = ()
+                self.curmax = 0
                 name = ""
                 if self.state.copy_until is not None:
                     pstate = k.IN_COPY
@@ -900,62 +965,83 @@ class LineParser:
                     pstate = k.START
     __iter__ = parse
 
-class StackItem:
-    pass
+class ElementStackItem:
+    """An open element and the prefixes declared when it was started.
 
-class ElementStackItem(StackItem):
-    def __init__(self, name, qname):
+    prefixes is a sequence of (prefix, uri) pairs, where uri is the binding
+    the prefix had before the element, or None if it was unbound.
+    """
+    __slots__ = ("name", "qname", "prefixes")
+    def __init__(self, name, qname, prefixes=()):
         self.name = name
         self.qname = qname
-    def end(self, ch):
-        ch.endElementNS(self.name, self.qname)
+        self.prefixes = prefixes
     def __repr__(self):
         return "ElementStackItem " + repr(self.name) + " " + self.qname
 
-class PrefixStackItem(StackItem):
-    def __init__(self, prefix):
-        self.prefix = prefix
-    def end(self, ch):
-        ch.endPrefixMapping(self.prefix)
-    def __repr__(self):
-        return "PrefixStackItem " + self.prefix
-
 class ContentHandlerWrapper:
+    """Keeps track of open elements and the namespaces in scope.
+
+    A prefix mapping is only started when an element needs a prefix that is
+    unbound or bound to a different URI at that point, and ends with the
+    element.
+    """
     NS_TROFF = "http://ns.crustytoothpaste.net/troff"
+    NS_XML = "http://www.w3.org/XML/1998/namespace"
     def __init__(self, ch, state):
         self.ch = ch
         self.stack = []
         self.state = state
+        self.bindings = {"xml": self.NS_XML}
     def __getattr__(self, name):
+        if name.startswith("__"):
+            # Don't forward special methods looked up by pickle and copy,
+            # which may happen before ch is set.
+            raise AttributeError(name)
         return getattr(self.ch, name)
     def endDocument(self):
-        for i in reversed(self.stack):
-            i.end(self.ch)
+        while self.stack:
+            self._end(self.stack.pop())
         self.ch.endDocument()
-    def startPrefixMapping(self, prefix, uri):
-        self.stack.append(PrefixStackItem(prefix))
-        self.ch.startPrefixMapping(prefix, uri)
-    def endPrefixMapping(self, prefix):
-        self.stack.pop().end(self.ch)
-    def startElementNS(self, name, qname, attrs):
-        mapping = {}
-        if ':' in qname:
-            mapping[qname.split(':')[0]] = name[0]
+    def replay(self, events, other):
+        """Send recorded events and continue from where other left off."""
+        for name, args in events:
+            getattr(self.ch, name)(*args)
+        self.stack = list(other.stack)
+        self.bindings = dict(other.bindings)
+    def _declare(self, prefix, uri, declared):
+        old = self.bindings.get(prefix)
+        if old != uri:
+            declared.append((prefix, old))
+            self.bindings[prefix] = uri
+            self.ch.startPrefixMapping(prefix, uri)
+    def _end(self, item):
+        self.ch.endElementNS(item.name, item.qname)
+        for prefix, uri in reversed(item.prefixes):
+            self.ch.endPrefixMapping(prefix)
+            if uri is None:
+                del self.bindings[prefix]
+            else:
+                self.bindings[prefix] = uri
+    def _start(self, name, qname, attrs, declared):
+        prefix, sep, local = qname.partition(":")
+        if sep:
+            self._declare(prefix, name[0], declared)
         for aqname in attrs.getQNames():
-            if ':' in aqname:
-                mapping[aqname.split(':')[0]] = attrs.getNameByQName(aqname)[0]
-        for prefix, uri in mapping.items():
-            self.startPrefixMapping(prefix, uri)
-        self.stack.append(ElementStackItem(name, qname))
+            prefix, sep, local = aqname.partition(":")
+            if sep:
+                self._declare(prefix, attrs.getNameByQName(aqname)[0],
+                        declared)
+        self.stack.append(ElementStackItem(name, qname, declared))
         self.ch.startElementNS(name, qname, attrs)
+    def startElementNS(self, name, qname, attrs):
+        self._start(name, qname, attrs, [])
     def endElementNS(self, name, qname):
-        while len(self.stack) > 0:
+        while self.stack:
             item = self.stack.pop()
-            item.end(self.ch)
-            if hasattr(item, "qname") and item.qname == qname:
+            self._end(item)
+            if item.qname == qname:
                 break
-        while len(self.stack) > 0 and hasattr(self.stack[-1], "prefix"):
-            self.stack.pop().end(self.ch)
     @classmethod
     def _makeAttributes(klass, at):
         values = {}
@@ -970,8 +1056,7 @@ class ContentHandlerWrapper:
             attrs = self._makeAttributes(at)
         self.startTroffElement("inline", attrs)
     def endInline(self):
-        tos = self.stack[-1]
-        if hasattr(tos, "qname") and tos.qname == "_troff:inline":
+        if self.stack and self.stack[-1].qname == "_troff:inline":
             self.endTroffElement("inline")
     def startBlock(self, attrs=None):
         if attrs is None:
@@ -982,24 +1067,34 @@ class ContentHandlerWrapper:
         if len(self.stack) == 0:
             return
         if force:
-            tos = self.stack[-1]
-            while hasattr(tos, "qname") and tos.qname != "_troff:block":
-                tos.end(self)
+            while self.stack[-1].qname != "_troff:block":
+                self._end(self.stack.pop())
                 if len(self.stack) == 0:
                     return
-                tos = self.stack[-1]
         self.endTroffElement("block")
         self.ignorableWhitespace("\n")
     def startTroffElement(self, localname, attrs=None):
         if attrs is None:
             attrs = Attributes({}, {})
+        declared = []
         for p, u in self.state.mapping.items():
-            self.startPrefixMapping(p, u)
-        self.startElementNS((self.NS_TROFF, localname), "_troff:"+localname,
-                attrs)
+            self._declare(p, u, declared)
+        self._start((self.NS_TROFF, localname), "_troff:"+localname, attrs,
+                declared)
     def endTroffElement(self, localname):
         self.endElementNS((self.NS_TROFF, localname), "_troff:"+localname)
 
+class EventRecorder:
+    """A content handler which records every event sent to it."""
+    def __init__(self):
+        self.events = []
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        def record(*args):
+            self.events.append((name, args))
+        return record
+
 class Font:
     def __init__(self, variant=None, weight=None):
         self.variant = variant if variant is not None else "normal"
@@ -1012,7 +1107,7 @@ class ParserState:
     def __init__(self, env, flags):
         self.env = env
         self.flags = [flags]
-        self.requests = {}
+        self.requests = tenorsax.sources.troff.stringlike.RequestTable()
         self.numregs = {}
         self.nregs = {}
         self.copy_until = None
@@ -1020,6 +1115,8 @@ class ParserState:
         self.copy_start = False
         self.macroargs = []
         self.macrodirs = []
+        # Paths found by .mso for each name, or None if there was none.
+        self.mso_paths = {}
         self.recursion = 512
         self.font_names = {"TR": 1, "R": 1, "TI": 2, "I": 2, "TB": 3, "B": 3,
                 "TBI": 4, "BI": 4}
@@ -1030,13 +1127,23 @@ class ParserState:
         self.mapping = {
                 "xml": "http://www.w3.org/XML/1998/namespace"
         }
+        # Resolved qnames for .start and .end, which depend on mapping.
+        self.qnames = {}
         self.filename = ""
-        self.trace = 0
+        self.trace = trace_from_environment()
+        self.profiler = None
         self.conditionals = []
+        # Files read by .so and .mso, which a snapshot of this state depends
+        # on.
+        self.files_read = []
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        # Tracing and profiling belong to the process, not the snapshot.
+        self.trace = trace_from_environment()
+        self.profiler = None
     def _initialize_requests(self):
-        for k, v in tenorsax.sources.troff.requests.__dict__.items():
-            if k.startswith("RequestImpl_"):
-                self.requests[k[12:]] = v
+        for k, v in tenorsax.sources.troff.requests.IMPLEMENTATIONS.items():
+            self.requests[k] = v(self)
     def _initialize_numregs(self):
         self.numregs = tenorsax.sources.troff.numeric.initialize_registers(self)
     def set_copy_mode(self, macro, ending):
@@ -1059,23 +1166,53 @@ class ParserState:
         return self.get_flags() & self.F_EXTNAME
 
 class TroffParser(xml.sax.xmlreader.IncrementalParser):
-    def __init__(self):
-        self.parser = Parser()
+    """An incremental SAX parser for troff.
+
+    Each call to feed lexes and emits events for every complete line received
+    so far; close processes whatever remains and ends the document.
+    """
+    def __init__(self, bufsize=2**16):
+        xml.sax.xmlreader.IncrementalParser.__init__(self, bufsize)
+        self.ch = None
         self.dh = None
         self.enth = None
         self.eh = None
-    def parse(self, source):
-        pass
+        self.reset()
+    def prepareParser(self, source):
+        self.parser.state.filename = source.getSystemId() or ""
     def feed(self, data):
-        self.parser.lp.inject(data)
+        if self.done:
+            return
+        if isinstance(data, bytes):
+            data = self.decoder.decode(data)
+        self.source.feed(data)
+        self._run()
     def close(self):
-        pass
+        if not self.done:
+            self.source.feed(self.decoder.decode(b"", True))
+            self.source.close()
+            self._run()
+        self.parser._tear_down()
+    def _run(self):
+        if self.items is None:
+            self.parser._set_up()
+            self.items = self.parser.lp.parse()
+        # Once the document has ended, by .ex or otherwise, further input is
+        # ignored, as it is when parsing in one step.
+        self.done = self.parser._process(self.items)
     def reset(self):
-        pass
+        self.parser = Parser(self.ch)
+        self.source = FeedSource()
+        self.parser.lp.data.source = self.source
+        self.decoder = io.IncrementalNewlineDecoder(
+                codecs.getincrementaldecoder("UTF-8")(), True)
+        self.items = None
+        self.done = False
     def getContentHandler(self):
-        return self.parser.state.ch
+        return self.ch
     def setContentHandler(self, handler):
-        self.parser.state.ch = handler
+        self.ch = handler
+        self.parser.state.ch.ch = handler
     def getDTDHandler(self):
         return self.dh
     def setDTDHandler(self, handler):
@@ -1095,32 +1232,97 @@ class Parser:
         self.state = ParserState(self.env, 0)
         self.lp = LineParser(self.state, "")
         self.state.ch = ContentHandlerWrapper(ch, self.state)
+        self.preloaded = None
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        del d["lp"]
+        return d
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.lp = LineParser(self.state, "")
+    def set_content_handler(self, ch):
+        self.state.ch = ContentHandlerWrapper(ch, self.state)
+    def preload(self, paths):
+        """Process the files named in paths ahead of the document.
+
+        This is meant for macro packages.  The events they produce are recorded
+        and sent to the content handler when the document is parsed, which
+        gives the same result as parsing them as part of the document.  A
+        preloaded parser can parse only one document, but it can be copied,
+        for instance by forking, to parse several.
+        """
+        recorder = EventRecorder()
+        self.set_content_handler(recorder)
+        self._set_up()
+        self.lp.data.source = self._read_files(paths)
+        self._process(self.lp.parse())
+        self.preloaded = (recorder.events, self.state.ch)
     def _set_up(self):
+        if self.state.profiler is not None:
+            self.state.profiler.start()
+        if self.preloaded is not None:
+            self.state.ch.replay(*self.preloaded)
+            return
         self.state.ch.startDocument()
         self.state.ch.startTroffElement("main")
         self.state.ch.startBlock()
     def _tear_down(self):
         self.state.ch.endDocument()
+        if self.state.profiler is not None:
+            self.state.profiler.finish()
+    @staticmethod
+    def _filename_request(filename):
+        return '.do tenorsax filename "' + filename + '"\n'
+    @classmethod
+    def _annotate(klass, finput):
+        """Yield lines from a fileinput object, marking where files start."""
+        for line in finput:
+            if finput.isfirstline():
+                yield klass._filename_request(finput.filename())
+            yield line
+    @staticmethod
+    def _read_files(paths):
+        for path in paths:
+            yield FileSource(path)
     def parse(self, finput):
-        try:
-            s = ""
-            for line in finput:
-                if finput.isfirstline():
-                    s += '.do tenorsax filename "' + finput.filename() + '"\n'
-                s += line
-            self.lp.inject(s)
-        except AttributeError:
+        """Parse a document.
+
+        finput may be a string, a fileinput object, or any other iterable of
+        strings.  Input other than a string is read lazily as the lexer needs
+        it, so output begins before all of the input has been read.
+        """
+        if isinstance(finput, str):
             self.lp.inject(finput)
+        elif hasattr(finput, "isfirstline"):
+            self.lp.data.source = self._annotate(finput)
+        else:
+            self.lp.data.source = iter(finput)
         self._set_up()
+        self._process(self.lp.parse())
+        self._tear_down()
+    def _process(self, items):
+        """Invoke items from the lexer until the input ends or runs dry.
+
+        Return False if the input ran dry and True if the document has ended.
+        """
         try:
-            for item in self.lp.parse():
-                log(item, type(item))
+            prof = self.state.profiler
+            for item in items:
+                if item is None:
+                    return False
+                if prof is not None:
+                    # Close the frames of any macros whose bodies ended before
+                    # this line began.
+                    prof.unwind(self.lp.line_depth)
                 item.invoke(self.lp)
         except IndexError:
             pass
         except StopIteration:
             pass
-        self._tear_down()
+        return True
+    def parse_files(self, paths):
+        """Parse the concatenation of the files named in paths."""
+        self.parse(self._read_files(paths))
  
 def create_parser():
     return TroffParser()
@@ -0,0 +1,61 @@
+import collections
+import time
+
+class Profiler:
+    """Measures the time spent in each troff request and macro.
+
+    Time is attributed to the stack of macro calls active at the time, so that
+    the results can be written as collapsed stacks for a flame graph, as well
+    as summarized per name.  The bottom of every stack is a frame named root,
+    which covers everything that happens outside of any request.
+    """
+    def __init__(self, root="troff", clock=time.perf_counter):
+        self.root = root
+        self.clock = clock
+        # Each frame is a list of name, kind, start time and time spent in
+        # children.
+        self.frames = []
+        self.stacks = collections.Counter()
+        self.stats = {}
+        self.active = collections.Counter()
+    def depth(self):
+        """Return the number of frames other than the root frame."""
+        return len(self.frames) - 1
+    def start(self):
+        self.enter(self.root, "")
+    def enter(self, name, kind):
+        self.frames.append([name, kind, self.clock(), 0.0])
+        self.active[name] += 1
+    def leave(self):
+        (name, kind, start, children) = self.frames.pop()
+        elapsed = self.clock() - start
+        path = tuple(f[0] for f in self.frames) + (name,)
+        self.stacks[path] += elapsed - children
+        stats = self.stats.setdefault(name, [kind, 0, 0.0, 0.0])
+        stats[1] += 1
+        self.active[name] -= 1
+        # Only count the outermost call of a recursive macro in its total.
+        if not self.active[name]:
+            stats[2] += elapsed
+        stats[3] += elapsed - children
+        if self.frames:
+            self.frames[-1][3] += elapsed
+    def unwind(self, depth):
+        """Leave frames until only depth frames besides the root remain."""
+        while len(self.frames) > depth + 1:
+            self.leave()
+    def finish(self):
+        while self.frames:
+            self.leave()
+    def write_collapsed(self, fp):
+        """Write the collapsed stacks with the self time in microseconds."""
+        for path, elapsed in sorted(self.stacks.items()):
+            fp.write("{} {}\n".format(";".join(path), round(elapsed * 1e6)))
+    def write_table(self, fp, n=20):
+        """Write the n names with the most self time."""
+        rows = sorted(self.stats.items(), key=lambda x: x[1][3], reverse=True)
+        fp.write("{:<20} {:<24} {:>8} {:>12} {:>12}\n".format("name", "kind",
+            "calls", "total ms", "self ms"))
+        for name, (kind, calls, total, own) in rows[:n]:
+            fp.write("{:<20} {:<24} {:>8} {:>12.3f} {:>12.3f}\n".format(name,
+                kind, calls, total * 1e3, own * 1e3))
@@ -4,28 +4,29 @@ import tenorsax.sources.troff.stringlike
 
 from xml.sax.xmlreader import AttributesNSImpl as Attributes
 
-from tenorsax.util import log
+from tenorsax.util import TRACE_FILE, trace, trace_flags
+from tenorsax.sources.troff.input import FileSource
 from tenorsax.sources.troff.numeric import IntegerNumberRegister, FloatNumberRegister
+from tenorsax.sources.troff.stringlike import (F_TERMINAL, F_NAME, F_NUMERIC,
+        F_INCREMENTAL, F_CONDITIONAL, F_EXECUTABLE)
 
 class RequestImplementation(tenorsax.sources.troff.stringlike.StringNamespacedData):
-    F_TERMINAL = 1
-    F_NAME = 2
-    F_NUMERIC = 4
-    F_INCREMENTAL = 12
-    F_CONDITIONAL = 16
-    F_EXECUTABLE = 32
+    """A request.
+
+    Each request is bound once to the parser state and the same object is used
+    every time it is invoked.  arg_flags holds the F_* flags for each argument
+    and max_args the number of arguments after which the remainder of the line
+    forms the last argument.
+    """
+    F_TERMINAL = F_TERMINAL
+    F_NAME = F_NAME
+    F_NUMERIC = F_NUMERIC
+    F_INCREMENTAL = F_INCREMENTAL
+    F_CONDITIONAL = F_CONDITIONAL
+    F_EXECUTABLE = F_EXECUTABLE
     def __init__(self, state):
         tenorsax.sources.troff.stringlike.StringNamespacedData.__init__(self, state)
         self.flags = 0
-    def max_args(self):
-        return 0
-    def _arg_flags(self, i):
-        return 0
-    def arg_flags(self, i):
-        try:
-            return self._arg_flags(i)
-        except IndexError:
-            return 0
     #def long_last_arg(self):
     #    return self.flags & self.F_LONGLAST
     #def first_arg_is_name(self):
@@ -34,9 +35,15 @@ class RequestImplementation(tenorsax.sources.troff.stringlike.StringNamespacedDa
         return ""
 
 class XMLRequestImplementation(RequestImplementation):
-    def _arg_flags(self, i):
-        return 0
     def _tuple_from_qname(self, qname):
+        try:
+            return self.state.qnames[qname]
+        except KeyError:
+            pass
+        result = self._resolve_qname(qname)
+        self.state.qnames[qname] = result
+        return result
+    def _resolve_qname(self, qname):
         prefix = None
         localname = None
         uri = None
@@ -50,10 +57,8 @@ class XMLRequestImplementation(RequestImplementation):
         return (prefix, uri, localname, qname)
 
 class RequestImpl_als(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_NAME, self.F_NAME)[i]
-    def max_args(self):
-        return 2
+    arg_flags = (F_NAME, F_NAME)
+    max_args = 2
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) < 2:
@@ -61,8 +66,7 @@ class RequestImpl_als(RequestImplementation):
         self.state.requests[args[0]] = self.state.requests[args[1]]
 
 class RequestImpl_bp(RequestImplementation):
-    def max_args(self):
-        return 1
+    max_args = 1
     def execute(self, callinfo):
         args = callinfo.args
         self.state.ch.startTroffElement("break-page")
@@ -79,10 +83,11 @@ class RequestImpl_do(RequestImplementation):
         from tenorsax.sources.troff.parse import Invocable
         req = Invocable(self.state, *callinfo.args)
         try:
-            macro = self.state.requests[req.name](self.state)
+            macro = self.state.requests[req.name]
             macro.preparse()
-            macro.execute(req)
+            res = macro.execute(req)
             macro.postparse()
+            return res
         except KeyError:
             pass
     def preparse(self):
@@ -91,10 +96,8 @@ class RequestImpl_do(RequestImplementation):
         self.state.pop_flags()
 
 class RequestImpl_de(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_NAME, self.F_NAME)[i]
-    def max_args(self):
-        return 2
+    arg_flags = (F_NAME, F_NAME)
+    max_args = 2
     def execute(self, callinfo):
         args = callinfo.args
         # FIXME: what to do in this case?
@@ -106,10 +109,8 @@ class RequestImpl_de(RequestImplementation):
             self.state.set_copy_mode(args[0], args[1])
 
 class RequestImpl_ds(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_NAME, self.F_TERMINAL)[i]
-    def max_args(self):
-        return 2
+    arg_flags = (F_NAME, F_TERMINAL)
+    max_args = 2
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) == 0:
@@ -119,10 +120,8 @@ class RequestImpl_ds(RequestImplementation):
         self.state.requests[args[0]] = tenorsax.sources.troff.stringlike.StringData(self.state, args[1])
 
 class RequestImpl_el(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_EXECUTABLE,)[i]
-    def max_args(self):
-        return 1
+    arg_flags = (F_EXECUTABLE,)
+    max_args = 1
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) == 0:
@@ -132,10 +131,7 @@ class RequestImpl_el(RequestImplementation):
             return (args[0], None)
 
 class RequestImpl_end(XMLRequestImplementation):
-    def _arg_flags(self, i):
-        return 0
-    def max_args(self):
-        return 1
+    max_args = 1
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) < 1:
@@ -147,18 +143,12 @@ class RequestImpl_end(XMLRequestImplementation):
             pass
 
 class RequestImpl_ex(RequestImplementation):
-    def _arg_flags(self, i):
-        return 0
-    def max_args(self):
-        return 0
+    max_args = 0
     def execute(self, callinfo):
         raise StopIteration
 
 class RequestImpl_ft(RequestImplementation):
-    def _arg_flags(self, i):
-        return 0
-    def max_args(self):
-        return 1
+    max_args = 1
     def execute(self, callinfo):
         args = callinfo.args
         env = self.state.env[0]
@@ -181,10 +171,8 @@ class RequestImpl_ft(RequestImplementation):
         self.state.ch.startInline()
 
 class RequestImpl_ie(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_CONDITIONAL, self.F_EXECUTABLE)[i]
-    def max_args(self):
-        return 2
+    arg_flags = (F_CONDITIONAL, F_EXECUTABLE)
+    max_args = 2
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) == 0:
@@ -194,10 +182,8 @@ class RequestImpl_ie(RequestImplementation):
             return (args[1], None)
 
 class RequestImpl_if(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_CONDITIONAL, self.F_EXECUTABLE)[i]
-    def max_args(self):
-        return 2
+    arg_flags = (F_CONDITIONAL, F_EXECUTABLE)
+    max_args = 2
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) == 0:
@@ -206,10 +192,8 @@ class RequestImpl_if(RequestImplementation):
             return (args[1], None)
 
 class RequestImpl_ig(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_NAME,)[i]
-    def max_args(self):
-        return 1
+    arg_flags = (F_NAME,)
+    max_args = 1
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) == 0:
@@ -218,56 +202,58 @@ class RequestImpl_ig(RequestImplementation):
             self.state.set_copy_mode(None, args[0])
 
 class RequestImpl_mso(RequestImplementation):
-    def _arg_flags(self, i):
-        return 0
-    def max_args(self):
-        return 1
+    max_args = 1
+    def _find(self, name):
+        for md in self.state.macrodirs:
+            for suffix in ("", ".tmac"):
+                path = os.path.expanduser(md + "/" + name + suffix)
+                if self.state.trace & TRACE_FILE:
+                    trace(self.state, TRACE_FILE, "mso-try", path=path)
+                if os.path.isfile(path):
+                    return path
+        return None
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) == 0:
             return
-        for md in self.state.macrodirs:
-            for suffix in ("", ".tmac"):
-                path = os.path.expanduser(md + "/" + args[0] + suffix)
-                log("path", path)
-                s = ""
-                try:
-                    s += '.do tenorsax filename "' + path + '"\n'
-                    with open(path) as fp:
-                        s += "".join(fp.readlines())
-                    s += '.do tenorsax filename "' + self.state.filename + '"\n'
-                    log("path successful")
-                    return (s, None)
-                except:
-                    pass
-        return ("", None)
+        paths = self.state.mso_paths
+        try:
+            path = paths[args[0]]
+        except KeyError:
+            path = paths[args[0]] = self._find(args[0])
+        if path is None:
+            return
+        source = FileSource(path)
+        self.state.files_read.append(path)
+        if self.state.trace & TRACE_FILE:
+            trace(self.state, TRACE_FILE, "mso-found", path=path)
+        return (source, None)
 
 class RequestImpl_namespace(RequestImplementation):
-    def _arg_flags(self, i):
-        return 0
-    def max_args(self):
-        return 2
+    max_args = 2
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) != 2:
             return
         self.state.mapping[args[0]] = args[1]
+        self.state.qnames.clear()
 
 class RequestImpl_nf(RequestImplementation):
     def execute(self, callinfo):
         self.state.env[0].fill = False
 
 class NumberRegisterRequestImplementation(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_NAME, self.F_INCREMENTAL, self.F_NUMERIC)[i]
-    def max_args(self):
-        return 3
+    arg_flags = (F_NAME, F_INCREMENTAL, F_NUMERIC)
+    max_args = 3
+    @classmethod
+    def _number(klass, s):
+        return klass.func(decimal.Decimal(s))
     @classmethod
     def _value(klass, cur, diff):
         try:
             if diff[0] in "+-":
-                return cur + klass.func(decimal.Decimal(diff))
-            return klass.func(decimal.Decimal(diff))
+                return cur + klass._number(diff)
+            return klass._number(diff)
         except:
             return cur
     def execute(self, callinfo):
@@ -281,33 +267,36 @@ class NumberRegisterRequestImplementation(RequestImplementation):
             diff = args[1]
         try:
             if len(args) >= 3:
-                inc = self.func(decimal.Decimal(args[2]))
+                inc = self._number(args[2])
         except:
             inc = 0
-        curval = 0
-        if name in self.state.numregs:
+        reg = self.state.numregs.get(name)
+        if type(reg) is self.register:
             # We don't use value() here because it will autoincrement.  We don't
             # want that.
-            curval = self.state.numregs[name].val
-        self.store(name, curval, diff, inc)
+            reg.set(self._value(reg.val, diff), inc)
+            return
+        curval = reg.val if reg is not None else 0
+        self.state.numregs[name] = self.register(self.state, name,
+                self._value(curval, diff), inc, "0")
 
 class RequestImpl_nr(NumberRegisterRequestImplementation):
     func = staticmethod(int)
-    def store(self, name, curval, diff, inc):
-        self.state.numregs[name] = IntegerNumberRegister(self.state, name,
-                self._value(curval, diff), inc, "0")
+    register = IntegerNumberRegister
+    @staticmethod
+    def _number(s):
+        try:
+            return int(s)
+        except ValueError:
+            return int(decimal.Decimal(s))
 
 class RequestImpl_nrf(NumberRegisterRequestImplementation):
     func = staticmethod(decimal.Decimal)
-    def store(self, name, curval, diff, inc):
-        self.state.numregs[name] = FloatNumberRegister(self.state, name,
-                self._value(curval, diff), inc, "0")
+    register = FloatNumberRegister
 
 class RequestImpl_recursionlimit(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_NUMERIC, self.F_NUMERIC)[i]
-    def max_args(self):
-        return 2
+    arg_flags = (F_NUMERIC, F_NUMERIC)
+    max_args = 2
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) < 2:
@@ -319,10 +308,8 @@ class RequestImpl_recursionlimit(RequestImplementation):
             pass
 
 class RequestImpl_rm(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_NAME,)[i]
-    def max_args(self):
-        return 1
+    arg_flags = (F_NAME,)
+    max_args = 1
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) < 1:
@@ -330,42 +317,33 @@ class RequestImpl_rm(RequestImplementation):
         del self.state.requests[args[0]]
 
 class RequestImpl_rn(RequestImplementation):
-    def _arg_flags(self, i):
-        return (self.F_NAME, self.F_NAME)[i]
-    def max_args(self):
-        return 2
+    arg_flags = (F_NAME, F_NAME)
+    max_args = 2
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) < 2:
             return
-        self.state.requests[args[1]] = self.state.requests[args[0]]
-        del self.state.requests[args[0]]
+        self.state.requests.rename(args[0], args[1])
 
 class RequestImpl_so(RequestImplementation):
-    def _arg_flags(self, i):
-        return 0
-    def max_args(self):
-        return 1
+    max_args = 1
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) == 0:
             return
-        s = ""
         if args[0].startswith("/"):
             path = args[0]
         else:
             d = os.path.dirname(self.state.filename)
             path = os.path.join(d, args[0])
-        log("path", path)
-        s += '.do tenorsax filename "' + path + '"\n'
-        with open(path) as fp:
-            s += "".join(fp.readlines())
-        s += '.do tenorsax filename "' + self.state.filename + '"\n'
-        return (s, None)
+        if self.state.trace & TRACE_FILE:
+            trace(self.state, TRACE_FILE, "so", path=path)
+        source = FileSource(path)
+        self.state.files_read.append(path)
+        return (source, None)
 
 class RequestImpl_start(XMLRequestImplementation):
-    def max_args(self):
-        return 1024
+    max_args = 1024
     def execute(self, callinfo):
         args = callinfo.args
         if len(args) < 1:
@@ -385,10 +363,7 @@ class RequestImpl_start(XMLRequestImplementation):
             pass
 
 class RequestImpl_tenorsax(RequestImplementation):
-    def _arg_flags(self, i):
-        return 0
-    def max_args(self):
-        return 2
+    max_args = 2
     @staticmethod
     def _get_boolean(s):
         try:
@@ -409,8 +384,9 @@ class RequestImpl_tenorsax(RequestImplementation):
             self.state.filename = args[1]
         elif args[0] == "macrodir":
             self.state.macrodirs.append(args[1])
+            self.state.mso_paths.clear()
         elif args[0] == "trace":
-            self.state.trace = int(args[1])
+            self.state.trace = trace_flags(args[1])
         elif args[0] == "get-implementation":
             name = args[1]
             self.state.numregs[name] = IntegerNumberRegister(self.state, name,
@@ -419,3 +395,6 @@ class RequestImpl_tenorsax(RequestImplementation):
             name = args[1]
             self.state.numregs[name] = IntegerNumberRegister(self.state, name,
                 int(bool(self.state.flags[0])), 0, "0")
+
+IMPLEMENTATIONS = dict((k[12:], v) for k, v in list(globals().items())
+        if k.startswith("RequestImpl_"))
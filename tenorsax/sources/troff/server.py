@@ -0,0 +1,206 @@
+"""A server that converts troff documents for clients on a local socket.
+
+The server keeps a parser with the macro packages loaded for each set of
+packages it has been asked for, and a copy of it is used for each document, so
+a conversion costs only the work of the document itself.  Stylesheets are
+compiled once as well.
+
+Each connection carries any number of requests, one after the other.  A request
+is a line of JSON, an object with the device, a list of macro package names and
+the length of the document in bytes, and optionally the file name of the
+document, followed by the document in UTF-8.  The reply is a line of JSON with
+the exit status, any error messages and the length of the output in bytes,
+followed by the output.
+
+Connections are handled by a fixed number of worker threads.  Once all of them
+are busy and the queue of waiting connections is full, the server stops
+accepting connections until a worker is free.  A connection keeps its worker
+until it is closed or has been idle for RequestHandler.timeout seconds.
+Documents can use .so to read any file the server can, so the server should
+only be reachable by trusted clients.
+"""
+
+import concurrent.futures
+import io
+import json
+import os
+import pickle
+import socket
+import socketserver
+import threading
+
+import tenorsax.sources.troff.snapshot
+
+class Renderer:
+    """Converts documents using parsers prepared ahead of time.
+
+    make_filter(device, output) returns the content handler writing the given
+    device to the text stream output, find_macro(name) the path of the macro
+    package called name, or None, and cachedir is passed on to
+    preloaded_parser.  init, if not None, is the path of a package loaded
+    before all others.
+    """
+    def __init__(self, make_filter, find_macro, init=None, cachedir=None):
+        self.make_filter = make_filter
+        self.find_macro = find_macro
+        self.init = init
+        self.cachedir = cachedir
+        self.templates = {}
+        self.lock = threading.Lock()
+    def parser(self, macros):
+        """Return a fresh parser with the macro packages in macros loaded."""
+        paths = [self.init] if self.init is not None else []
+        for name in macros:
+            path = self.find_macro(name)
+            if path is not None:
+                paths.append(path)
+        key = tuple(paths)
+        with self.lock:
+            template = self.templates.get(key)
+            if template is None:
+                p = tenorsax.sources.troff.snapshot.preloaded_parser(paths,
+                        self.cachedir)
+                template = pickle.dumps(p, pickle.HIGHEST_PROTOCOL)
+                self.templates[key] = template
+        return pickle.loads(template)
+    def render(self, request, text):
+        """Convert text as described by request.
+
+        Return the exit status, the output and any error messages.
+        """
+        output = io.StringIO()
+        try:
+            p = self.parser(request.get("macros", ()))
+            p.set_content_handler(self.make_filter(request.get("device",
+                "troff-xml"), output))
+            p.state.filename = request.get("filename", "")
+            p.parse(text)
+        except Exception as e:
+            return (1, output.getvalue(), "E: {0}\n".format(e))
+        return (0, output.getvalue(), "")
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # A connection holds a worker for as long as it is open, so idle ones are
+    # closed after this many seconds.
+    timeout = 30
+    def handle(self):
+        try:
+            self._serve()
+        except (TimeoutError, BrokenPipeError, ConnectionResetError):
+            # The client has gone away or stopped talking.
+            pass
+    def _serve(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line.decode("UTF-8"))
+                length = request["length"]
+                if type(length) is not int or length < 0:
+                    raise ValueError("invalid length")
+                text = self.rfile.read(length).decode("UTF-8")
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(1, "", "E: bad request: {0}\n".format(e))
+                return
+            self._reply(*self.server.renderer.render(request, text))
+    def _reply(self, status, output, errors):
+        data = output.encode("UTF-8")
+        header = {"status": status, "errors": errors, "length": len(data)}
+        self.wfile.write(json.dumps(header).encode("UTF-8") + b"\n")
+        self.wfile.write(data)
+        self.wfile.flush()
+
+class _PoolMixIn:
+    """Handle connections in a bounded pool of worker threads."""
+    # How often, in seconds, to check for a shutdown while waiting for a
+    # worker to be free.
+    slot_wait = 0.5
+    def _set_up_pool(self, workers, queue):
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.stopping = threading.Event()
+    def process_request(self, request, client_address):
+        # Waiting here keeps further connections in the listen queue.
+        while not self.slots.acquire(timeout=self.slot_wait):
+            if self.stopping.is_set():
+                self.shutdown_request(request)
+                return
+        self.pool.submit(self._work, request, client_address)
+    def _work(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+    def shutdown(self):
+        self.stopping.set()
+        super().shutdown()
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+class UnixRenderServer(_PoolMixIn, socketserver.UnixStreamServer):
+    def __init__(self, path, renderer, workers=4, queue=16):
+        self.renderer = renderer
+        self._set_up_pool(workers, queue)
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+class TCPRenderServer(_PoolMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    def __init__(self, address, renderer, workers=4, queue=16):
+        self.renderer = renderer
+        self._set_up_pool(workers, queue)
+        socketserver.TCPServer.__init__(self, address, RequestHandler)
+
+def parse_address(address):
+    """Convert an address given by a user into a path or (host, port) pair.
+
+    An address containing a slash is the path of a Unix socket; anything else
+    is a port, optionally preceded by a host and a colon, which defaults to
+    the loopback address.
+    """
+    if "/" in address:
+        return address
+    (host, sep, port) = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+def make_server(address, renderer, workers=4, queue=16):
+    """Return a server listening on address, as given to parse_address."""
+    addr = parse_address(address)
+    if isinstance(addr, str):
+        return UnixRenderServer(addr, renderer, workers, queue)
+    return TCPRenderServer(addr, renderer, workers, queue)
+
+class Client:
+    """A connection to a render server."""
+    def __init__(self, address):
+        addr = parse_address(address)
+        if isinstance(addr, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.rfile = self.sock.makefile("rb")
+    def render(self, text, device="troff-xml", macros=(), filename=None):
+        """Convert text, returning the status, output and error messages."""
+        data = text.encode("UTF-8")
+        request = {"device": device, "macros": list(macros),
+                "length": len(data)}
+        if filename is not None:
+            request["filename"] = filename
+        self.sock.sendall(json.dumps(request).encode("UTF-8") + b"\n" + data)
+        reply = json.loads(self.rfile.readline().decode("UTF-8"))
+        output = self.rfile.read(reply["length"]).decode("UTF-8")
+        return (reply["status"], output, reply["errors"])
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
@@ -0,0 +1,94 @@
+"""Snapshots of a parser with its macro packages already loaded.
+
+Loading the macro packages is the same for every document, so a parser that
+has preloaded them is saved to a cache file and restored on the next run.  The
+snapshot records each file it depends on, the packages, whatever they read with
+.so and .mso, and the modules of this parser, along with their contents and
+modification times; if any of them has changed, the snapshot is discarded.
+
+Changes that make .mso find a different file, such as a new file earlier in
+the search path, are not detected.
+"""
+
+import hashlib
+import os
+import os.path
+import pickle
+import sys
+import tempfile
+
+import tenorsax
+import tenorsax.sources.troff.parse
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _stamp(path):
+    with open(path, "rb") as fp:
+        st = os.fstat(fp.fileno())
+        return (path, st.st_mtime_ns, st.st_size, _digest(fp.read()))
+
+def _modules():
+    d = os.path.dirname(os.path.abspath(__file__))
+    return sorted(os.path.join(d, f) for f in os.listdir(d)
+            if f.endswith(".py"))
+
+def cache_key(paths):
+    """Return the name of the snapshot for the packages named in paths."""
+    items = [tenorsax.__version__, sys.version]
+    items.extend(os.path.abspath(p) for p in paths)
+    return _digest("\0".join(items).encode("UTF-8")) + ".pickle"
+
+def _valid(stamps):
+    try:
+        return all(_stamp(s[0]) == s for s in stamps)
+    except OSError:
+        return False
+
+def load(path):
+    """Return the parser saved in path, or None if it is missing or stale."""
+    try:
+        with open(path, "rb") as fp:
+            if not _valid(pickle.load(fp)):
+                return None
+            return pickle.load(fp)
+    except Exception:
+        return None
+
+def save(path, parser, paths):
+    """Save parser, which has preloaded the files in paths, to path."""
+    deps = list(paths) + parser.state.files_read + _modules()
+    stamps = [_stamp(p) for p in dict.fromkeys(deps)]
+    d = os.path.dirname(path) or "."
+    os.makedirs(d, exist_ok=True)
+    (fd, tmp) = tempfile.mkstemp(dir=d, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump(stamps, fp, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(parser, fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def preloaded_parser(paths, cachedir=None):
+    """Return a parser that has preloaded the files in paths.
+
+    If cachedir is not None, the parser is restored from a snapshot there when
+    possible, and otherwise saved to one.
+    """
+    if cachedir is None:
+        p = tenorsax.sources.troff.parse.Parser(None)
+        p.preload(paths)
+        return p
+    path = os.path.join(cachedir, cache_key(paths))
+    p = load(path)
+    if p is not None:
+        return p
+    p = tenorsax.sources.troff.parse.Parser(None)
+    p.preload(paths)
+    try:
+        save(path, p, paths)
+    except OSError:
+        pass
+    return p
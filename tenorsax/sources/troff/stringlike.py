@@ -1,10 +1,17 @@
+# Flags for the arguments of a request.
+F_TERMINAL = 1
+F_NAME = 2
+F_NUMERIC = 4
+F_INCREMENTAL = 12
+F_CONDITIONAL = 16
+F_EXECUTABLE = 32
+
 class StringNamespacedData:
+    __slots__ = ("state",)
+    arg_flags = ()
+    max_args = 0
     def __init__(self, state):
         self.state = state
-    def max_args(self):
-        return 0
-    def arg_flags(self, i):
-        return 0
     def preparse(self):
         pass
     def postparse(self):
@@ -14,19 +21,63 @@ class StringNamespacedData:
     def first_arg_is_name(self):
         return False
 
+def _lex_signature(value):
+    """Return everything about a table entry that affects lexing its name.
+
+    Whether a name is defined matters as well, since the d condition of .if and
+    .ie is tested while the line is lexed.
+    """
+    if value is None:
+        return None
+    return (value.arg_flags, value.max_args, type(value).preparse)
+
+class RequestTable(dict):
+    """The table of requests, macros and strings.
+
+    generation is incremented whenever a change to the table can change how a
+    line is lexed, that is, when a name is added or removed or its argument
+    flags change, so that anything derived from lexing can tell when it has
+    become stale.  Redefining an existing string or macro does not affect
+    lexing, since they take no flags.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.generation = 0
+    def _changed(self, old, new):
+        if _lex_signature(old) != _lex_signature(new):
+            self.generation += 1
+    def __setitem__(self, key, value):
+        old = dict.get(self, key)
+        dict.__setitem__(self, key, value)
+        self._changed(old, value)
+    def __delitem__(self, key):
+        old = dict.get(self, key)
+        dict.__delitem__(self, key)
+        self._changed(old, None)
+    def pop(self, key, *args):
+        old = dict.get(self, key)
+        value = dict.pop(self, key, *args)
+        self._changed(old, None)
+        return value
+    def __reduce__(self):
+        return (self.__class__, (dict(self),), self.__dict__)
+    def rename(self, old, new):
+        """Move the entry named old to new as a single change."""
+        value = dict.pop(self, old)
+        dict.__setitem__(self, new, value)
+        # The old name is no longer defined.
+        self.generation += 1
+
 class StringData(StringNamespacedData):
     """Represents a string in the request table.
     
-    Because an object of this type must be present in the request table (because
-    otherwise there would be no way to store the data), the special call method
-    is implemented so that it looks like a normal constructor for a request.
+    Like a request, an object of this type is stored in the request table and
+    executed directly whenever the string is invoked.
     """
+    __slots__ = ("data",)
     def __init__(self, state, data):
         StringNamespacedData.__init__(self, state)
         self.data = data
-    def __call__(self, state):
-        self.state = state
-        return self
     def execute(self, callinfo):
         self.state.ch.characters(str(self.data))
     def __str__(self):
@@ -37,14 +88,26 @@ class MacroData(StringNamespacedData):
    
     This is implemented very similarly to StringData, and most of the same
     comments apply.
+
+    Lines of the body are lexed again every time the macro is invoked, except
+    for lines containing no escapes, whose lexed form is cached here.  The
+    cache is discarded when the generation of the request table changes.
     """
+    __slots__ = ("data", "lexed", "generation")
     def __init__(self, state, data):
         StringNamespacedData.__init__(self, state)
         self.data = data
-    def __call__(self, state):
-        self.state = state
-        return self
+        self.lexed = {}
+        self.generation = None
     def execute(self, callinfo):
-        return (str(self.data), callinfo)
+        return (self, callinfo)
+    def get_lexed(self, key, pos):
+        """Return the cached line starting at pos, lexed under key."""
+        if self.generation != self.state.requests.generation:
+            self.lexed = {}
+            self.generation = self.state.requests.generation
+        return self.lexed.get((key, pos))
+    def set_lexed(self, key, pos, line):
+        self.lexed[(key, pos)] = line
     def __str__(self):
         return str(self.data)
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+import io
+import unittest
+import xml.sax.handler
+
+import tenorsax.sources
+import tenorsax.sources.asciidoc.parse
+import tenorsax.sources.markdown.parse
+
+from tenorsax.sources import START_INLINE, END_INLINE
+
+class InlineTests(unittest.TestCase):
+    @staticmethod
+    def parse(text):
+        """Return the tokens for text, with markup written as tags."""
+        parser = tenorsax.sources.asciidoc.parse.AsciiDocParser.inline
+        tokens = parser.parse(text)
+        res = []
+        for token in tokens:
+            if type(token) is str:
+                res.append(token)
+            elif token[0] == START_INLINE:
+                res.append("<" + token[1] + ">")
+            else:
+                res.append("</" + token[1] + ">")
+        return "".join(res)
+    def test_quotes(self):
+        self.assertEqual(self.parse("a *b* and _c_"),
+                "a <strong>b</strong> and <emphasis>c</emphasis>")
+    def test_nested(self):
+        self.assertEqual(self.parse("*a _b_ c*"), "<strong>a " +
+                "<emphasis>b</emphasis> c</strong>")
+    def test_unconstrained(self):
+        self.assertEqual(self.parse("x**y**z"), "x<strong>y</strong>z")
+    def test_constrained(self):
+        self.assertEqual(self.parse("x*y* *z *"), "x*y* *z *")
+    def test_same_quote(self):
+        self.assertEqual(self.parse("*a *b* c*"), "<strong>a *b</strong> c*")
+        self.assertEqual(self.parse("**a **b** c**"),
+                "<strong>a </strong>b<strong> c</strong>")
+    def test_fallback(self):
+        self.assertEqual(self.parse("a **b* c"), "a <strong>*b</strong> c")
+        self.assertEqual(self.parse("x __y_ z"), "x <emphasis>_y</emphasis> z")
+        self.assertEqual(self.parse("x ++y+ z"),
+                "x <monospace>+y</monospace> z")
+        self.assertEqual(self.parse("see ``foo' bar"),
+                "see <quote>`foo</quote> bar")
+    def test_unclosed(self):
+        self.assertEqual(self.parse("*a _b* c_"),
+                "<strong>a _b</strong> c_")
+    def test_attrlist(self):
+        self.assertEqual(self.parse("[red]#a# [b]"), "<span>a</span> [b]")
+    def test_escape(self):
+        self.assertEqual(self.parse("\\*a* \\<"), "*a* <")
+    def test_replacements(self):
+        self.assertEqual(self.parse("a <= b -> (C)"),
+                "a \u21d0 b \u2192 \u00a9")
+    def test_entities(self):
+        self.assertEqual(self.parse("&#169;&#x2014;"), "\u00a9\u2014")
+    def test_entity_boundary(self):
+        self.assertEqual(self.parse("&#169;*a*"),
+                "\u00a9<strong>a</strong>")
+    def test_dense(self):
+        text = "*a _b ' " * 10000
+        self.assertEqual(self.parse(text), text)
+
+class EventTests(unittest.TestCase):
+    @staticmethod
+    def events(parser, text):
+        events = []
+        class Handler(xml.sax.handler.ContentHandler):
+            def startElementNS(self, name, qname, attrs):
+                if name[1] == "inline":
+                    events.append(attrs.getValueByQName("type"))
+            def endElementNS(self, name, qname):
+                if name[1] == "inline":
+                    events.append("end")
+            def characters(self, content):
+                events.append(content)
+        parser(Handler()).parse(io.StringIO(text))
+        return events
+    def test_asciidoc(self):
+        self.assertEqual(self.events(
+            tenorsax.sources.asciidoc.parse.AsciiDocParser,
+            "T\n=\n\n<i-x>*a* (C)\n"),
+            ["T", "<i-x>", "strong", "a", "end", " \u00a9\n"])
+    def test_markdown(self):
+        self.assertEqual(self.events(
+            tenorsax.sources.markdown.parse.MarkdownParser,
+            "# T\n\n<i-x>a</i-x>\n"), ["T", "\n<i-x>a</i-x>\n"])
+    def test_underline_title(self):
+        events = self.events(tenorsax.sources.asciidoc.parse.AsciiDocParser,
+            "Doc\n===\n\nSub\n---\n\ntext\n")
+        self.assertEqual(events, ["Doc", "Sub", "text\n"])
+    def test_markdown_comment_title(self):
+        events = self.events(tenorsax.sources.markdown.parse.MarkdownParser,
+            "T\n=\n\n## U ##\n\nx <!-- c -->\n")
+        self.assertEqual(events, ["T", "U", "x "])
+
+class ClassifierTests(unittest.TestCase):
+    def test_classify(self):
+        lines = tenorsax.sources.asciidoc.parse.AsciiDocParser.LINES
+        self.assertEqual(lines.classify(" \t\n"), ("blank", None))
+        self.assertEqual(lines.classify("")[0], "blank")
+        self.assertEqual(lines.classify("// x\n")[0], "comment")
+        self.assertEqual(lines.classify("/// x\n")[0], None)
+        self.assertEqual(lines.classify("[quote]\n")[0], "block-style")
+        (kind, mo) = lines.classify("== Title ==\n")
+        self.assertEqual((kind, mo.group(1), mo.group(2)),
+                ("title", "==", "Title"))
+        (kind, mo) = lines.classify("~~~~\n")
+        self.assertEqual((kind, mo.group(1)), ("underline", "~~~~"))
+        self.assertEqual(lines.classify("~~-~\n"), (None, None))
+        self.assertEqual(lines.classify("text\n"), (None, None))
+
+class StreamTests(unittest.TestCase):
+    def test_lazy(self):
+        pulled = []
+        seen = []
+        class Handler(xml.sax.handler.ContentHandler):
+            def characters(self, content):
+                seen.append(len(pulled))
+        def lines():
+            yield "T\n"
+            yield "=\n"
+            for i in range(100):
+                pulled.append(i)
+                yield "\n"
+                yield "text\n"
+        for parser in (tenorsax.sources.asciidoc.parse.AsciiDocParser,
+                tenorsax.sources.markdown.parse.MarkdownParser):
+            del pulled[:]
+            del seen[:]
+            parser(Handler()).parse(lines())
+            self.assertEqual(len(pulled), 100)
+            self.assertLess(seen[1], 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+
+import unittest
+
+import tenorsax.bench
+
+class CorpusTests(unittest.TestCase):
+    def test_deterministic(self):
+        for name in tenorsax.bench.CORPORA:
+            self.assertEqual(tenorsax.bench.generate(name, 5, 1),
+                    tenorsax.bench.generate(name, 5, 1))
+    def test_seed(self):
+        self.assertNotEqual(tenorsax.bench.generate("troff-text", 5, 1),
+                tenorsax.bench.generate("troff-text", 5, 2))
+
+class StageTimerTests(unittest.TestCase):
+    def test_nested(self):
+        ticks = iter([0, 1, 4, 10])
+        timer = tenorsax.bench.StageTimer(lambda: next(ticks))
+        timer.enter("outer")
+        timer.call("inner", lambda: None)
+        timer.leave()
+        self.assertEqual(timer.times, {"outer": 7, "inner": 3})
+
+class RunTests(unittest.TestCase):
+    def test_troff(self):
+        res = tenorsax.bench.run(["troff-macros"], size=2, repeat=1)
+        stages = res["results"]["troff-macros"]["stages"]
+        for stage in ("lexer", "requests", "sax", "xslt", "total"):
+            self.assertIn(stage, stages)
+    def test_compare(self):
+        old = tenorsax.bench.run(["markdown-long"], size=2, repeat=1)
+        new = tenorsax.bench.run(["markdown-long"], size=2, repeat=1)
+        new["results"]["markdown-long"]["stages"]["parser"] = 1.0
+        rows = tenorsax.bench.compare(old, new)
+        regressed = [(r[0], r[1]) for r in rows if r[4]]
+        self.assertIn(("markdown-long", "parser"), regressed)
+        self.assertFalse(any(r[4] for r in tenorsax.bench.compare(old, old)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+import io
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+import xml.sax.saxutils
+
+import lxml.etree
+import lxml.sax
+
+import tenorsax.bench
+import tenorsax.filters
+import tenorsax.filters.xslt
+import tenorsax.sources.asciidoc.parse
+import tenorsax.sources.markdown.parse
+import tenorsax.sources.troff.parse
+
+DOCUMENT = """<r xmlns="urn:d" xmlns:t="http://ns.crustytoothpaste.net/troff">
+ a <t:main> m <t:block> b1 <t:break-page>bp</t:break-page>
+ x<t:block>nested   z</t:block></t:block><q>tail <t:break-page>gone<t:block>in
+ </t:block></t:break-page>  t </q><t:inline>i <t:block> </t:block></t:inline>
+ </t:main> end <e xmlns=""/></r>
+"""
+
+def _parse_xml(text):
+    def feed(ch):
+        lxml.sax.saxify(lxml.etree.fromstring(text), ch)
+    return feed
+
+def _parse_corpus(name):
+    text = tenorsax.bench.generate(name, 10)
+    def feed(ch):
+        if name == "asciidoc-quotes":
+            p = tenorsax.sources.asciidoc.parse.AsciiDocParser(ch)
+            p.parse(text.splitlines(True))
+        elif name == "markdown-long":
+            p = tenorsax.sources.markdown.parse.MarkdownParser(ch)
+            p.parse(text.splitlines(True))
+        else:
+            Parser = tenorsax.sources.troff.parse.Parser
+            paths = ["tmac/init.tmac"]
+            if name == "troff-macros":
+                paths.append("tmac/xd.tmac")
+            Parser(ch).parse(itertools.chain(Parser._read_files(paths),
+                [text]))
+    return feed
+
+class EquivalenceTestCase(unittest.TestCase):
+    """Checks that the native filters give the same results as lxml."""
+    @staticmethod
+    def text(f, feed):
+        try:
+            feed(f)
+        except Exception as e:
+            return str(e)
+        return f.get_string()
+    @staticmethod
+    def xml(klass, feed, *args):
+        out = io.StringIO()
+        writer = xml.sax.saxutils.XMLGenerator(out, "UTF-8", True)
+        try:
+            feed(klass(writer, *args))
+        except Exception as e:
+            return (out.getvalue(), str(e))
+        return (out.getvalue(), None)
+    def assertSameText(self, feed):
+        native = tenorsax.filters.TrimFilter()
+        xslt = tenorsax.filters.xslt.TextXSLTTransformer(None, "xslt/trim.xsl")
+        self.assertEqual(self.text(native, feed), self.text(xslt, feed))
+    def assertSameXML(self, feed):
+        native = self.xml(tenorsax.filters.XMLFormatFilter, feed)
+        xslt = self.xml(tenorsax.filters.xslt.XSLTTransformer, feed,
+                "xslt/format-xml.xsl")
+        # The native filter streams, so it may already have written some
+        # output when it finds an error.
+        if native[1] is not None and xslt[1] is not None:
+            self.assertEqual(native[1], xslt[1])
+        else:
+            self.assertEqual(native, xslt)
+        return native
+
+class TrimTests(EquivalenceTestCase):
+    def test_corpora(self):
+        for name in tenorsax.bench.CORPORA:
+            self.assertSameText(_parse_corpus(name))
+    def test_document(self):
+        self.assertSameText(_parse_xml(DOCUMENT))
+    def test_output(self):
+        out = io.StringIO()
+        f = tenorsax.filters.TrimFilter(out)
+        _parse_xml(DOCUMENT)(f)
+        self.assertIsNone(f.get_string())
+        self.assertTrue(out.getvalue().startswith("\n a b1 bp xnested z\n"))
+
+class XMLFormatTests(EquivalenceTestCase):
+    def test_corpora(self):
+        for name in tenorsax.bench.CORPORA:
+            self.assertSameXML(_parse_corpus(name))
+    def test_namespaces(self):
+        self.assertSameXML(_parse_xml('<t:main xmlns:t=' +
+            '"http://ns.crustytoothpaste.net/troff"><t:block xmlns:h="urn:h" ' +
+            'xmlns:u="urn:u"><h:p xmlns:v="urn:v"><h:b xmlns:v="urn:v" ' +
+            'xmlns:h="urn:h" u:c="2"/><t:inline xmlns:v="urn:v2"><h:c ' +
+            'v:x="1" xmlns:z="urn:z"/></t:inline><?pi x?></h:p></t:block>' +
+            '</t:main>'))
+    def test_default_namespace(self):
+        self.assertSameXML(_parse_xml('<t:main xmlns:t=' +
+            '"http://ns.crustytoothpaste.net/troff"><a xmlns="urn:d"><b/>' +
+            '<c xmlns=""><d/></c></a></t:main>'))
+    def test_stray_text(self):
+        self.assertEqual(self.assertSameXML(_parse_xml(DOCUMENT))[1],
+                "stray text not allowed")
+    def test_early_stray_text(self):
+        self.assertEqual(self.assertSameXML(_parse_xml('<t:main xmlns:t=' +
+            '"http://ns.crustytoothpaste.net/troff">x<a/></t:main>')),
+            ("", "stray text not allowed"))
+    def test_late_stray_text(self):
+        self.assertEqual(self.assertSameXML(_parse_xml('<t:main xmlns:t=' +
+            '"http://ns.crustytoothpaste.net/troff"><t:block><a>1</a>' +
+            '</t:block>x</t:main>'))[1], "stray text not allowed")
+    def test_multiple_roots(self):
+        self.assertEqual(self.assertSameXML(_parse_xml('<t:main xmlns:t=' +
+            '"http://ns.crustytoothpaste.net/troff"><t:block><a/><b/>' +
+            '</t:block></t:main>'))[1],
+            "multiple root elements not allowed")
+    def test_separate_roots(self):
+        self.assertSameXML(_parse_xml('<t:main xmlns:t=' +
+            '"http://ns.crustytoothpaste.net/troff"><t:block><a>1</a>' +
+            '</t:block><t:block><b>2</b></t:block></t:main>'))
+
+class SelectionTests(unittest.TestCase):
+    def test_native(self):
+        self.assertIsInstance(tenorsax.filters.text_filter(None,
+            "xslt/trim.xsl"), tenorsax.filters.TrimFilter)
+        self.assertIsInstance(tenorsax.filters.xml_filter(None,
+            "/usr/share/tenorsax/xslt/format-xml.xsl"),
+            tenorsax.filters.XMLFormatFilter)
+    def test_xslt(self):
+        self.assertIsInstance(tenorsax.filters.xml_filter(None,
+            "xslt/format-fo.xsl"), tenorsax.filters.xslt.XSLTTransformer)
+    def test_same_name(self):
+        with tempfile.TemporaryDirectory() as d:
+            for name in ("trim.xsl", "format-xml.xsl"):
+                shutil.copy(os.path.join("xslt", name), d)
+            self.assertIsInstance(tenorsax.filters.text_filter(None,
+                os.path.join(d, "trim.xsl")),
+                tenorsax.filters.xslt.TextXSLTTransformer)
+            self.assertIsInstance(tenorsax.filters.xml_filter(None,
+                os.path.join(d, "format-xml.xsl")),
+                tenorsax.filters.xslt.XSLTTransformer)
+
+if __name__ == '__main__':
+    unittest.main()
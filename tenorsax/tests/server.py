@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import tenorsax.filters
+import tenorsax.generators
+import tenorsax.sources.troff.parse
+import tenorsax.sources.troff.server
+
+def make_filter(fmt, output):
+    if fmt == "sax":
+        return tenorsax.generators.SAXGenerator(output)
+    return tenorsax.filters.text_filter(output, "xslt/trim.xsl")
+
+def find_macro(name):
+    path = "tmac/" + name + ".tmac"
+    return path if os.path.exists(path) else None
+
+class ServerTests(unittest.TestCase):
+    doc = "doc/quick-test.mxd"
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.address = os.path.join(tmp.name, "sock")
+        self.renderer = tenorsax.sources.troff.server.Renderer(make_filter,
+                find_macro, "tmac/init.tmac")
+        server = tenorsax.sources.troff.server.make_server(self.address,
+                self.renderer, 2, 1)
+        self.server = server
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+    def client(self):
+        c = tenorsax.sources.troff.server.Client(self.address)
+        self.addCleanup(c.close)
+        return c
+    def expected(self, fmt):
+        output = io.StringIO()
+        p = tenorsax.sources.troff.parse.Parser(make_filter(fmt, output))
+        p.parse_files(["tmac/init.tmac", "tmac/xd.tmac", self.doc])
+        return output.getvalue()
+    def test_concurrent(self):
+        with open(self.doc) as fp:
+            text = fp.read()
+        results = []
+        def work():
+            c = tenorsax.sources.troff.server.Client(self.address)
+            for fmt in ("test", "sax"):
+                results.append((fmt, c.render(text, fmt, ["xd"], self.doc)))
+            c.close()
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 8)
+        for fmt, res in results:
+            self.assertEqual(res, (0, self.expected(fmt), ""))
+        self.assertEqual(list(self.renderer.templates),
+                [("tmac/init.tmac", "tmac/xd.tmac")])
+    def test_shutdown_when_busy(self):
+        address = os.path.join(os.path.dirname(self.address), "busy")
+        server = tenorsax.sources.troff.server.make_server(address,
+                self.renderer, 1, 0)
+        server.slot_wait = 0.05
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.start()
+        # The first connection holds the only worker and the second waits for
+        # it.
+        clients = [tenorsax.sources.troff.server.Client(address)
+                for i in range(2)]
+        time.sleep(0.2)
+        stopper = threading.Thread(target=server.shutdown)
+        stopper.start()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+        thread.join()
+        for c in clients:
+            c.close()
+        server.server_close()
+    def test_bad_request(self):
+        c = self.client()
+        c.sock.sendall(b"{}\n")
+        line = c.rfile.readline()
+        self.assertIn(b'"status": 1', line)
+
+    def test_bad_length(self):
+        for length in ("-1", "1.5", '"1"'):
+            c = self.client()
+            c.sock.sendall(b'{"length": ' + length.encode() + b'}\nabc')
+            line = c.rfile.readline()
+            self.assertIn(b'"status": 1', line)
+            self.assertIn(b"invalid length", line)
+    def test_disconnect(self):
+        errors = []
+        self.server.handle_error = lambda *args: errors.append(args)
+        started = threading.Event()
+        closed = threading.Event()
+        def render(request, text):
+            started.set()
+            closed.wait(5)
+            return (0, "x" * 100000, "")
+        self.renderer.render = render
+        c = tenorsax.sources.troff.server.Client(self.address)
+        c.sock.sendall(b'{"length": 0}\n')
+        started.wait(5)
+        c.close()
+        closed.set()
+        # Closing the server waits for the connection to be handled.
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(errors, [])
+
+if __name__ == '__main__':
+    unittest.main()
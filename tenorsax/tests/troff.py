@@ -1,15 +1,32 @@
 #!/usr/bin/python3
 
+import gc
+import io
+import json
+import os
 import re
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
+import warnings
+import xml.sax.handler
+import xml.sax.saxutils
 
+import tenorsax.generators
+import tenorsax.sources.troff.input
+import tenorsax.sources.troff.numeric
 import tenorsax.sources.troff.parse
+import tenorsax.sources.troff.profiler
+import tenorsax.sources.troff.snapshot
+import tenorsax.filters
 import tenorsax.filters.xslt
 
 class TroffToTextTestCase(unittest.TestCase):
     @staticmethod
     def t_run(inp):
-        f = tenorsax.filters.xslt.TextXSLTTransformer(None, "xslt/trim.xsl")
+        f = tenorsax.filters.text_filter(None, "xslt/trim.xsl")
         p = tenorsax.sources.troff.parse.Parser(f)
         p.parse(inp)
         return f.get_string()
@@ -25,11 +42,27 @@ class RequestTests(TroffToTextTestCase):
         self.assertEqual(self.t_run(".do als BR br\nabc\n.BR\ndef\n"), "abc\ndef\n")
     def test_alias_oldname(self):
         self.assertEqual(self.t_run(".do als BR br\nabc\n.br\ndef\n"), "abc\ndef\n")
+    def test_alias_arguments(self):
+        self.assertEqual(self.t_run(".do als NR nr\n.NR aa 2*3\n\\n(aa\n"),
+                "6\n")
+    def test_rename_missing(self):
+        self.assertEqual(self.t_run(".rn XX br\nabc\n.br\ndef\n"), "abc\ndef\n")
 
 class ExtendedModeTests(TroffToTextTestCase):
     def test_basic(self):
         self.assertEqual(self.t_run("abc\n.do br\ndef\n"), "abc\ndef\n")
 
+class TextTests(TroffToTextTestCase):
+    def test_long_line(self):
+        line = "word " * 2000
+        self.assertEqual(self.t_run(line + "\n"), line[:-1] + "\n")
+    def test_escapes(self):
+        self.assertEqual(self.t_run('.ds AA x\nabc\\*(AAdef\\*(AA\\&\n'),
+                "abcxdefx\u200b\n")
+    def test_delayed(self):
+        self.assertEqual(self.t_run('abc\\\\def\\\\\n'),
+                "abc\\def\\\n")
+
 class CopyModeTests(TroffToTextTestCase):
     def test_conditional(self):
         text = """.de AA
@@ -54,6 +87,10 @@ end
 """
         text2 = re.sub(r"([{}])", r"\\\1", text)
         self.assertEqual(self.t_run(text), self.t_run(text2))
+    def test_long_body(self):
+        body = "word " * 2000
+        self.assertEqual(self.t_run(".de AA\n" + body + "\n..\n.AA\n.AA\n"),
+                body + body[:-1] + "\n")
 
 class StringTests(TroffToTextTestCase):
     def setUp(self):
@@ -174,6 +211,25 @@ success.
 ..
 .AA text Some
 '''), 'Some\ntext\n')
+    def test_repeated(self):
+        self.assertEqual(self.t_run(self.gg + '.GG\n.GG\n.GG\n'),
+                "a b c\ne f g h i a b c\ne f g h i a b c\ne f g h i\n")
+    def test_repeated_rename(self):
+        self.assertEqual(self.t_run(self.gg + '.GG\n.rn br BR\n.GG\n' +
+            '.rn BR br\n.GG\n'),
+            "a b c\ne f g h i a b c e f g h i a b c\ne f g h i\n")
+    def test_nested_arguments(self):
+        self.assertEqual(self.t_run(r'''.de IN
+\\$1 \\n(.$
+..
+.de OU
+.IN inner
+\\$1 \\n(.$
+.IN last
+..
+.OU outer two
+\n(.$
+'''), 'inner 1 outer 2 last 1 0\n')
 
 class IgnoreTests(TroffToTextTestCase):
     def test_ignore(self):
@@ -249,6 +305,31 @@ class NumericParsingTests(TroffToTextTestCase):
         self.assertEqual(self.t_run('.nr no 3<>5\n\\n(no\n'), '1\n')
     def test_notequal_greater(self):
         self.assertEqual(self.t_run('.nr no 5<>3\n\\n(no\n'), '1\n')
+    def test_left_to_right(self):
+        self.assertEqual(self.t_run('.nr no 2+3*4-6\n\\n(no\n'), '14\n')
+    def test_parentheses(self):
+        self.assertEqual(self.t_run('.nr no 2+(3*4)\n\\n(no\n'), '14\n')
+    def test_negative_division(self):
+        self.assertEqual(self.t_run('.nr no 0-7/2\n\\n(no\n'), '-3\n')
+    def test_registers(self):
+        self.assertEqual(self.t_run('.nr aa 5\n.nr no \\n(aa*2+1\n\\n(no\n'),
+                '11\n')
+    def test_register_increment(self):
+        self.assertEqual(self.t_run('.nr aa 1 1\n.nr no \\n+(aa*10+\\n+(aa\n' +
+            '\\n(no \\n(aa\n'), '23 3\n')
+    def test_repeated(self):
+        self.assertEqual(self.t_run('.de AA\n.nr no \\\\n(no+1\n..\n' +
+            '.AA\n.AA\n.AA\n\\n(no\n'), '3\n')
+    def test_register_compiled_once(self):
+        tenorsax.sources.troff.numeric._expressions.clear()
+        self.assertEqual(self.t_run('.nr xx 0 1\n.de AA\n' +
+            '.nr b \\\\n+(xx*3+(\\\\n(xx-1)\n..\n.AA\n.AA\n.AA\n\\nb\n'),
+            '11\n')
+        # One entry each for 0, 1 and the expression in the macro.
+        self.assertEqual(len(tenorsax.sources.troff.numeric._expressions), 3)
+    def test_conditional_register(self):
+        self.assertEqual(self.t_run('.nr aa 4\n.if \\n(aa>3 yes\n' +
+            '.if \\n(aa>4 no\n'), 'yes\n')
 
 class FloatTests(TroffToTextTestCase):
     def test_creation_integer(self):
@@ -284,6 +365,12 @@ class FloatTests(TroffToTextTestCase):
     def test_increment_decrement_integer(self):
         self.assertEqual(self.t_run('.do nrf no 5 1\n\\n+(no \\n-(no \\n-(no\n'),
                 '6.0 5.0 4.0\n')
+    def test_expression(self):
+        self.assertEqual(self.t_run('.do tenorsax ext 1\n.nrf no 1.5*3\n' +
+            '\\n(no\n'), '4.5\n')
+    def test_replace_integer(self):
+        self.assertEqual(self.t_run('.nr no 5\n.do nrf no +0.5\n\\n(no\n'),
+                '5.5\n')
     def test_increment_decrement_float(self):
         self.assertEqual(self.t_run('.do nrf no 5.2 1.3\n\\n+(no \\n-(no \\n-(no\n'),
                 '6.5 5.2 3.9\n')
@@ -305,6 +392,20 @@ class ExtensionTests(TroffToTextTestCase):
         self.assertEqual(self.t_run(self.aa + ".do tenorsax ext 1\n.do tenorsax ext 0\n.AAA\n"), "disabled\n0\n")
     def test_implementation(self):
         self.assertEqual(self.t_run(".do tenorsax get-implementation im\n\\n(im\n"), "6450531\n")
+    def test_trace(self):
+        with tempfile.TemporaryFile("w+") as fp:
+            stderr = sys.stderr
+            sys.stderr = fp
+            try:
+                self.t_run(".do tenorsax trace undef,cond\n.zz\n.if 1 yes\n")
+            finally:
+                sys.stderr = stderr
+            fp.seek(0)
+            records = [json.loads(line) for line in fp]
+        self.assertEqual(records, [
+            {"category": "undef", "event": "undefined", "name": "zz"},
+            {"category": "cond", "event": "condition", "result": True},
+        ])
 
 class ConditionalTests(TroffToTextTestCase):
     def setUp(self):
@@ -463,5 +564,355 @@ class BugTests(TroffToTextTestCase):
 .PO eese
 """), "dip alone\ndip with cheese\n")
 
+class InputTests(TroffToTextTestCase):
+    def test_iterable(self):
+        self.assertEqual(self.t_run(iter([".de AA\n", "text\n..\n", ".AA\n"])),
+                "text\n")
+    def test_lazy(self):
+        pulled = []
+        seen = []
+        class Handler(xml.sax.handler.ContentHandler):
+            def characters(self, content):
+                seen.append(len(pulled))
+        def lines():
+            for i in range(100):
+                pulled.append(i)
+                yield "line\n.br\n"
+        p = tenorsax.sources.troff.parse.Parser(Handler())
+        p.parse(lines())
+        self.assertEqual(len(pulled), 100)
+        self.assertLess(seen[0], 5)
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "doc.tr")
+            with open(path, "wb") as fp:
+                fp.write(".de AA\r\nSome \u00e9\r\n..\r\n.AA\r\n".encode("UTF-8"))
+            f = tenorsax.filters.text_filter(None, "xslt/trim.xsl")
+            p = tenorsax.sources.troff.parse.Parser(f)
+            p.parse_files([path])
+            self.assertEqual(f.get_string(), "Some \u00e9\n")
+    def test_stdin(self):
+        with tempfile.TemporaryFile("w+") as fp:
+            fp.write(".ds AA text\n\\*(AA\n")
+            fp.seek(0)
+            f = tenorsax.filters.text_filter(None, "xslt/trim.xsl")
+            p = tenorsax.sources.troff.parse.Parser(f)
+            with unittest.mock.patch("sys.stdin", fp):
+                p.parse_files(["-"])
+            self.assertEqual(f.get_string(), "text\n")
+            self.assertFalse(fp.closed)
+    def test_unread_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "inc.tr")
+            with open(path, "w") as fp:
+                fp.write("not shown\n")
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                self.assertEqual(self.t_run("a\n.ex\n.so " + path + "\n"),
+                        "a\n")
+                source = tenorsax.sources.troff.input.FileSource(path)
+                del source
+                gc.collect()
+            self.assertEqual([w for w in caught
+                if issubclass(w.category, ResourceWarning)], [])
+    def test_so_nested(self):
+        with tempfile.TemporaryDirectory() as d:
+            os.mkdir(os.path.join(d, "sub"))
+            files = {"doc.tr": "a\n.so sub/b.tr\n.so c.tr\nf\n",
+                    "sub/b.tr": "b\n.so d.tr\ne\n", "sub/d.tr": "d\n",
+                    "c.tr": "c\n"}
+            for name, text in files.items():
+                with open(os.path.join(d, name), "w") as fp:
+                    fp.write(text)
+            f = tenorsax.filters.text_filter(None, "xslt/trim.xsl")
+            p = tenorsax.sources.troff.parse.Parser(f)
+            p.parse_files([os.path.join(d, "doc.tr")])
+            self.assertEqual(f.get_string(), "a b d e c f\n")
+            self.assertEqual(p.state.filename, os.path.join(d, "doc.tr"))
+    def test_mso_memoized(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "m.tmac"), "w") as fp:
+                fp.write(".ds xx yes\n")
+            p = tenorsax.sources.troff.parse.Parser(None)
+            p.set_content_handler(xml.sax.handler.ContentHandler())
+            p.parse(".do tenorsax macrodir " + d + "\n.do mso m\n.do mso n\n")
+            self.assertEqual(p.state.mso_paths,
+                    {"m": d + "/m.tmac", "n": None})
+            self.assertEqual(str(p.state.requests["xx"]), "yes")
+    def test_location(self):
+        data = tenorsax.sources.troff.input.InputStack()
+        data.push_source(tenorsax.sources.troff.input.FileSource("a",
+            ["one\ntw", "o\nthree\n"]))
+        self.assertEqual(data.location(), ("a", 1))
+        self.assertEqual(data.read_run("\n"), "one")
+        self.assertEqual(data.location(), ("a", 1))
+        data.read()
+        self.assertEqual(data.read_run("\n"), "tw")
+        data.push("x\n")
+        self.assertEqual(data.location(), ("a", 2))
+        data.read_run("\n")
+        data.read()
+        data.read_run("\n")
+        data.read()
+        self.assertEqual(data.location(), ("a", 2))
+        data.read()
+        self.assertEqual(data.location(), ("a", 3))
+
+class PreloadTests(unittest.TestCase):
+    macros = ["tmac/init.tmac", "tmac/xd.tmac"]
+    @staticmethod
+    def events(p, paths):
+        out = io.StringIO()
+        p.set_content_handler(tenorsax.generators.SAXGenerator(out))
+        p.parse_files(paths)
+        return out.getvalue()
+    def test_same_events(self):
+        Parser = tenorsax.sources.troff.parse.Parser
+        doc = "doc/quick-test.mxd"
+        p = Parser(None)
+        p.preload(self.macros)
+        self.assertEqual(self.events(p, [doc]),
+                self.events(Parser(None), self.macros + [doc]))
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w") as fp:
+            fp.write(text)
+        return path
+    def test_round_trip(self):
+        snapshot = tenorsax.sources.troff.snapshot
+        macros = PreloadTests.macros
+        doc = "doc/quick-test.mxd"
+        p = snapshot.preloaded_parser(macros, self.tmp.name)
+        expected = PreloadTests.events(p, [doc])
+        path = os.path.join(self.tmp.name, snapshot.cache_key(macros))
+        q = snapshot.load(path)
+        self.assertIsNotNone(q)
+        self.assertEqual(PreloadTests.events(q, [doc]), expected)
+    def test_stale(self):
+        snapshot = tenorsax.sources.troff.snapshot
+        inc = self.write("inc.tmac", ".ds xx old\n")
+        pkg = self.write("pkg.tmac", ".so inc.tmac\n")
+        p = snapshot.preloaded_parser([pkg], self.tmp.name)
+        path = os.path.join(self.tmp.name, snapshot.cache_key([pkg]))
+        self.assertIsNotNone(snapshot.load(path))
+        self.write("inc.tmac", ".ds xx new\n")
+        self.assertIsNone(snapshot.load(path))
+        p = snapshot.preloaded_parser([pkg], self.tmp.name)
+        self.assertEqual(str(p.state.requests["xx"]), "new")
+
+class FontTests(unittest.TestCase):
+    @staticmethod
+    def f_run(inp):
+        """Return a list of (font-weight, text) pairs for each text run."""
+        runs = []
+        weight = []
+        class Handler(xml.sax.handler.ContentHandler):
+            def startElementNS(self, name, qname, attrs):
+                qnames = attrs.getQNames()
+                if "_troff:font-weight" in qnames:
+                    weight.append(attrs.getValueByQName("_troff:font-weight"))
+                else:
+                    weight.append(weight[-1] if weight else None)
+            def endElementNS(self, name, qname):
+                weight.pop()
+            def characters(self, content):
+                runs.append((weight[-1], content))
+        p = tenorsax.sources.troff.parse.Parser(Handler())
+        p.parse(inp)
+        return [r for r in runs if r[1]]
+    def test_text(self):
+        self.assertEqual(self.f_run("a \\fBb\\fR c\n"),
+                [("normal", "a "), ("bold", "b"), ("normal", " c ")])
+    def test_argument(self):
+        self.assertEqual(self.f_run(".de XX\n\\\\$1\n..\n.XX \\fBb\\fP\n"),
+                [("bold", "b"), ("normal", " ")])
+    def test_private_use(self):
+        text = "\U00102204xft\U00102205B\U00102206"
+        self.assertEqual(self.f_run(text + "\n"), [("normal", text + " ")])
+
+class NamespaceTests(unittest.TestCase):
+    @staticmethod
+    def n_run(inp):
+        """Return the prefix mappings and elements started, in order."""
+        events = []
+        class Handler(xml.sax.handler.ContentHandler):
+            def startPrefixMapping(self, prefix, uri):
+                events.append(("xmlns", prefix, uri))
+            def startElementNS(self, name, qname, attrs):
+                events.append(("element", qname))
+        p = tenorsax.sources.troff.parse.Parser(Handler())
+        p.parse(".do tenorsax ext 1\n" + inp)
+        return [e for e in events
+                if e[0] == "xmlns" or not e[1].startswith("_troff:")]
+    def test_declared_once(self):
+        events = self.n_run("a \\fBb\\fR c\n.br\nd\n")
+        ns = tenorsax.sources.troff.parse.ContentHandlerWrapper.NS_TROFF
+        self.assertEqual(events, [("xmlns", "_troff", ns)])
+    def test_element(self):
+        events = self.n_run(".namespace h urn:h\n.start h:p h:id=a\ntext\n" +
+                ".start h:b\nbold\n.end h:b\n.end h:p\n")
+        self.assertEqual(events[1:], [("xmlns", "h", "urn:h"),
+            ("element", "h:p"), ("element", "h:b")])
+    def test_rebinding(self):
+        events = self.n_run(".namespace h urn:h\n.start h:p\n" +
+                ".namespace h urn:i\n.start h:b\n.end h:b\n.end h:p\n")
+        self.assertEqual(events[1:], [("xmlns", "h", "urn:h"),
+            ("element", "h:p"), ("xmlns", "h", "urn:i"), ("element", "h:b")])
+
+class ProfilerTests(unittest.TestCase):
+    def p_run(self, inp):
+        ticks = iter(range(1000))
+        self.prof = tenorsax.sources.troff.profiler.Profiler(
+                clock=lambda: next(ticks))
+        f = tenorsax.filters.text_filter(None, "xslt/trim.xsl")
+        p = tenorsax.sources.troff.parse.Parser(f)
+        p.state.profiler = self.prof
+        p.parse(inp)
+        return set(path for path in self.prof.stacks)
+    def test_nested(self):
+        paths = self.p_run(".de BB\nb\n.br\n..\n.de AA\n.BB\na\n..\n.AA\n")
+        self.assertIn(("troff", "AA", "BB", "br"), paths)
+        self.assertNotIn(("troff", "br"), paths)
+        self.assertEqual(self.prof.stats["BB"][:2], ["MacroData", 1])
+        self.assertEqual(self.prof.stats["de"][:2], ["RequestImpl_de", 2])
+    def test_last_line(self):
+        paths = self.p_run(".de BB\nb\n..\n.de AA\na\n.BB\n..\n.AA\n.br\n")
+        self.assertIn(("troff", "AA", "BB"), paths)
+        self.assertIn(("troff", "br"), paths)
+        self.assertEqual(self.prof.frames, [])
+    def test_collapsed(self):
+        self.p_run(".de AA\n.br\n..\n.AA\n")
+        fp = io.StringIO()
+        self.prof.write_collapsed(fp)
+        lines = fp.getvalue().splitlines()
+        self.assertIn("troff;AA;br", [l.split()[0] for l in lines])
+
+class FilterTests(unittest.TestCase):
+    def test_tree(self):
+        f = tenorsax.filters.xslt.GenericXSLTTransformer("xslt/format-xml.xsl")
+        p = tenorsax.sources.troff.parse.Parser(f)
+        p.parse(".do tenorsax ext 1\n.namespace h urn:h\n.start h:p\n" +
+                "text\n.end h:p\n")
+        root = f.get_tree().getroot()
+        self.assertEqual((root.tag, root.text), ("{urn:h}p", "text "))
+    def test_binary_output(self):
+        buf = io.BytesIO()
+        out = io.TextIOWrapper(buf, encoding="UTF-8")
+        out.write("x\n")
+        f = tenorsax.filters.xslt.TextXSLTTransformer(out, "xslt/trim.xsl")
+        p = tenorsax.sources.troff.parse.Parser(f)
+        p.parse("m\u00e9re\n")
+        self.assertEqual(buf.getvalue().decode("UTF-8"), "x\nm\u00e9re\n")
+        self.assertEqual(f.get_string(), "m\u00e9re\n")
+    def test_other_encoding(self):
+        buf = io.BytesIO()
+        out = io.TextIOWrapper(buf, encoding="UTF-16")
+        f = tenorsax.filters.xslt.TextXSLTTransformer(out, "xslt/trim.xsl")
+        p = tenorsax.sources.troff.parse.Parser(f)
+        p.parse("m\u00e9re\n")
+        out.flush()
+        self.assertEqual(buf.getvalue().decode("UTF-16"), "m\u00e9re\n")
+    def test_sax_output(self):
+        out = io.StringIO()
+        writer = xml.sax.saxutils.XMLGenerator(out, "UTF-8")
+        f = tenorsax.filters.xslt.XSLTTransformer(writer, "xslt/format-xml.xsl")
+        p = tenorsax.sources.troff.parse.Parser(f)
+        p.parse(".do tenorsax ext 1\n.namespace h urn:h\n.start h:p\n" +
+                "a&b\n.end h:p\n")
+        self.assertTrue(out.getvalue().endswith(
+            '<h:p xmlns:h="urn:h">a&amp;b </h:p>'))
+
+class IncrementalTests(unittest.TestCase):
+    def setUp(self):
+        self.f = tenorsax.filters.text_filter(None, "xslt/trim.xsl")
+        self.p = tenorsax.sources.troff.parse.create_parser()
+        self.p.setContentHandler(self.f)
+    def test_chunks(self):
+        text = ".de AA\n\\\\$1 text\n..\n.AA Some\n.br\nm\u00e9re\n"
+        data = text.encode("UTF-8")
+        for i in range(0, len(data), 3):
+            self.p.feed(data[i:i+3])
+        self.p.close()
+        self.assertEqual(self.f.get_string(), "Some text\nm\u00e9re\n")
+    def test_progressive(self):
+        seen = []
+        class Handler(xml.sax.handler.ContentHandler):
+            def characters(self, content):
+                seen.append(content)
+        self.p.setContentHandler(Handler())
+        self.p.feed("abc\nde")
+        self.assertEqual(seen, ["abc "])
+        self.p.feed("f\n")
+        self.assertEqual(seen, ["abc ", "def "])
+        self.p.close()
+    def test_register_in_place(self):
+        self.p.feed(".nr aa 1 2\n")
+        reg = self.p.parser.state.numregs["aa"]
+        self.p.feed(".nr aa +4\n")
+        self.p.close()
+        self.assertIs(self.p.parser.state.numregs["aa"], reg)
+        self.assertEqual((reg.val, reg.inc), (5, 0))
+    def test_lexed_cache(self):
+        self.p.feed(".de AA\n.ds xx y\n.nr yy 1\ntext\n..\n.de BB\n..\n.AA\n")
+        requests = self.p.parser.state.requests
+        macro = requests["AA"]
+        (generation, lexed) = (requests.generation, macro.lexed)
+        self.assertTrue(lexed)
+        self.p.feed(".AA\n.de BB\nx\n..\n.AA\n")
+        self.assertEqual(requests.generation, generation)
+        self.assertIs(macro.lexed, lexed)
+        self.p.feed(".do als zz nr\n.AA\n")
+        self.assertNotEqual(requests.generation, generation)
+        self.assertIsNot(macro.lexed, lexed)
+        self.p.close()
+        self.assertEqual(self.f.get_string(), "text text text text\n")
+    def test_lexed_defined(self):
+        text = (".de CK\n.ie dZZ yes\n.el no\n..\n.CK\n.de ZZ\n..\n.CK\n" +
+                ".rm ZZ\n.CK\n")
+        self.p.feed(text)
+        self.p.close()
+        self.assertEqual(self.f.get_string(), "no yes no\n")
+    def test_unterminated(self):
+        text = ".ds AA text\n\\*(AA\nmore"
+        self.p.feed(text)
+        self.p.close()
+        self.assertEqual(self.f.get_string(), TroffToTextTestCase.t_run(text))
+    def test_exit(self):
+        self.p.feed("plain\n.ex\nnot")
+        self.p.feed("shown\n")
+        self.p.close()
+        self.assertEqual(self.f.get_string(), "plain\n")
+
+class CommandTests(unittest.TestCase):
+    @staticmethod
+    def run_troff(*args, **kwargs):
+        return subprocess.run([sys.executable, "troff", "--no-cache"] +
+                list(args), capture_output=True, encoding="UTF-8", **kwargs)
+    def test_stdin(self):
+        res = self.run_troff("-Ttest", "-", input="a\n.br\nb\n")
+        self.assertEqual((res.returncode, res.stdout), (0, "a\nb\n"))
+    def test_missing_file(self):
+        res = self.run_troff("-Ttest", "/nonexistent/doc.tr")
+        self.assertEqual(res.returncode, 1)
+        self.assertTrue(res.stderr.startswith("E: "))
+        self.assertIn("/nonexistent/doc.tr", res.stderr)
+    def test_batch_same_name(self):
+        with tempfile.TemporaryDirectory() as d:
+            for sub in ("a", "b"):
+                os.mkdir(os.path.join(d, sub))
+                with open(os.path.join(d, sub, "doc.tr"), "w") as fp:
+                    fp.write(sub + "\n")
+            res = self.run_troff("-Ttest", "-j", "2", "--output-dir", d,
+                    os.path.join(d, "a", "doc.tr"),
+                    os.path.join(d, "b", "doc.tr"))
+            self.assertEqual(res.returncode, 1)
+            self.assertIn("doc.test", res.stderr)
+            self.assertFalse(os.path.exists(os.path.join(d, "doc.test")))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,30 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import unittest
+
+import tenorsax.util.batch
+
+class BatchTests(unittest.TestCase):
+    @staticmethod
+    def work(item):
+        if item == "raise":
+            raise ValueError("bad item")
+        print("pid {0} item {1}".format(os.getpid(), item), file=sys.stderr)
+        return int(item)
+    def test_order(self):
+        items = ["0", "1", "raise", "0", "2"]
+        res = list(tenorsax.util.batch.run(self.work, items, 3))
+        self.assertEqual([r[0] for r in res], items)
+        self.assertEqual([r[1] for r in res], [0, 1, 1, 0, 2])
+        self.assertIn("ValueError: bad item", res[2][2])
+        self.assertTrue(res[4][2].endswith("item 2\n"))
+    def test_separate(self):
+        res = list(tenorsax.util.batch.run(self.work, ["0", "0"], 1))
+        pids = set(r[2].split()[1] for r in res)
+        self.assertEqual(len(pids), 2)
+        self.assertNotIn(str(os.getpid()), pids)
+
+if __name__ == '__main__':
+    unittest.main()
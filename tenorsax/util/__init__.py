@@ -1,19 +1,78 @@
 #!/usr/bin/python3
 
+import json
 import os
 import sys
 
 # The request in question is not defined.
 TRACE_UNDEF = 1
+# Each line as it is lexed.
+TRACE_LEX = 2
+# Macro calls and the argument frames they create.
+TRACE_FRAME = 4
+# Number register lookups.
+TRACE_NUMERIC = 8
+# Conditions and their results.
+TRACE_COND = 16
+# Files read by .so and .mso.
+TRACE_FILE = 32
+# Line classification in the AsciiDoc and Markdown parsers.
+TRACE_MARKUP = 64
 
-def log(*args):
+TRACE_CATEGORIES = {
+    "undef": TRACE_UNDEF,
+    "lex": TRACE_LEX,
+    "frame": TRACE_FRAME,
+    "numeric": TRACE_NUMERIC,
+    "cond": TRACE_COND,
+    "file": TRACE_FILE,
+    "markup": TRACE_MARKUP,
+}
+TRACE_ALL = sum(TRACE_CATEGORIES.values())
+
+def trace_flags(spec):
+    """Convert a trace specification into a set of TRACE_* bits.
+
+    spec is either an integer or a comma-separated list of category names, in
+    which "all" stands for every category.  Unknown names are ignored.
+    """
+    try:
+        return int(spec)
+    except ValueError:
+        pass
+    bits = 0
+    for name in spec.split(","):
+        name = name.strip()
+        if name == "all":
+            bits |= TRACE_ALL
+        else:
+            bits |= TRACE_CATEGORIES.get(name, 0)
+    return bits
+
+def trace_from_environment():
+    """Return the trace bits requested in the environment.
+
+    TENORSAX_TRACE holds a trace specification; TENORSAX_DEBUG, if set, turns
+    on every category.
+    """
     if "TENORSAX_DEBUG" in os.environ:
-        print(*args, file=sys.stderr)
+        return TRACE_ALL
+    return trace_flags(os.environ.get("TENORSAX_TRACE", "0"))
+
+def trace(state, bit, event, **fields):
+    """Write a trace record to standard error if bit is set in state.trace.
+
+    Each record is one line of JSON containing the category, the event name
+    and any fields given.  Callers in hot paths should check state.trace & bit
+    themselves so that the fields aren't computed when tracing is off.
+    """
+    if not state.trace & bit:
+        return
+    record = {"category": _trace_names.get(bit, bit), "event": event}
+    record.update(fields)
+    print(json.dumps(record, default=str), file=sys.stderr)
 
-def trace(state, bit, *args):
-    """Print a message to standard error if bit is set in state.trace."""
-    if state.trace & bit:
-        print(*args, file=sys.stderr)
+_trace_names = dict((v, k) for k, v in TRACE_CATEGORIES.items())
 
 def chomp(line):
     if line[-1] == "\n":
@@ -0,0 +1,62 @@
+import gc
+import os
+import sys
+import tempfile
+import traceback
+
+def run(func, items, jobs=1):
+    """Call func on each of items in a forked process, jobs at a time.
+
+    Each child is forked from the current process, so it starts with the same
+    state no matter how many items came before it; before forking, objects are
+    moved out of the garbage collector's reach with gc.freeze so that the
+    children can share them copy-on-write.  func returns an exit status; if it
+    raises, the status is 1.
+
+    Yield (item, status, errors) for each item in the order of items, where
+    errors is whatever the child wrote to standard error.
+    """
+    items = list(items)
+    running = {}
+    results = {}
+    nxt = 0
+    done = 0
+    gc.collect()
+    gc.freeze()
+    try:
+        while done < len(items):
+            while nxt < len(items) and len(running) < max(jobs, 1):
+                errors = tempfile.TemporaryFile()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    _child(func, items[nxt], errors)
+                running[pid] = (nxt, errors)
+                nxt += 1
+            while done in results:
+                (status, text) = results.pop(done)
+                yield (items[done], status, text)
+                done += 1
+            if not running:
+                continue
+            (pid, status) = os.wait()
+            (i, errors) = running.pop(pid)
+            errors.seek(0)
+            text = errors.read().decode("UTF-8", "replace")
+            errors.close()
+            results[i] = (os.waitstatus_to_exitcode(status), text)
+    finally:
+        gc.unfreeze()
+
+def _child(func, item, errors):
+    status = 1
+    try:
+        os.dup2(errors.fileno(), sys.stderr.fileno())
+        status = func(item) or 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)